@@ -0,0 +1,114 @@
+"""
+Benchmark building the wide denorm_all_coins table with the 'joins'
+strategy (one CTE and LEFT JOIN per coin) and the 'pivot' strategy (one
+long-format scan and a DuckDB PIVOT) on synthetic coins.
+
+Usage:
+    python benchmarks/denorm_all_coins_benchmark.py --coins 23,100,500 --days 1095
+"""
+import argparse
+import os
+import time
+
+import duckdb
+from jinja2 import Environment
+
+MODEL_PATH = os.path.join(os.path.dirname(__file__), "..", "coindbt", "models", "denorm_all_coins.sql")
+
+
+def render_model(model_source, dbt_vars):
+    """Render the model for a full (non-incremental) build with refs as plain table names."""
+    env = Environment(extensions=["jinja2.ext.do"])
+    env.globals.update(
+        var=lambda name, default=None: dbt_vars.get(name, default),
+        ref=lambda name: name,
+        config=lambda **kwargs: "",
+        is_incremental=lambda: False,
+        this="denorm_all_coins",
+    )
+    return env.from_string(model_source).render()
+
+
+def build_synthetic_tables(conn, coin_count, days):
+    """Create per-coin denorm_<coin>_history tables and the long denorm_coin_history table."""
+    conn.execute(f"""
+        CREATE OR REPLACE TABLE denorm_coin_history AS
+        SELECT
+            'coin_' || c AS coin,
+            DATE '2020-01-01' + CAST(d AS INTEGER) AS date,
+            100 + c + sin(d / 10.0) AS current_price_usd,
+            1e9 * (1 + c) + d AS market_cap_usd
+        FROM range({coin_count}) AS coins(c), range({days}) AS days(d)
+        ORDER BY coin, date
+    """)
+    for c in range(coin_count):
+        conn.execute(f"""
+            CREATE OR REPLACE TABLE denorm_coin_{c}_history AS
+            SELECT date, current_price_usd, market_cap_usd
+            FROM denorm_coin_history WHERE coin = 'coin_{c}'
+        """)
+
+
+def time_build(conn, sql, table):
+    """Seconds to materialize ``sql`` into ``table``, or None if DuckDB rejects it."""
+    started = time.perf_counter()
+    try:
+        conn.execute(f"CREATE OR REPLACE TABLE {table} AS {sql}")
+    except duckdb.Error as e:
+        print(f"  {table}: {type(e).__name__}: {str(e).splitlines()[0]}")
+        return None
+    return time.perf_counter() - started
+
+
+def format_timing(seconds, width):
+    return f"{'failed':>{width}}" if seconds is None else f"{seconds:>{width - 1}.3f}s"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark denorm_all_coins build strategies")
+    parser.add_argument("--coins", type=str, default="23,100,500", help="Comma separated coin counts to test")
+    parser.add_argument("--days", type=int, default=1095, help="Days of history per coin")
+    args = parser.parse_args()
+
+    with open(MODEL_PATH) as f:
+        model_source = f.read()
+
+    conn = duckdb.connect()
+    print(f"{'coins':>6} {'joins':>10} {'pivot':>10} {'pivot/long':>11}  same output")
+    for coin_count in [int(n) for n in args.coins.split(',')]:
+        build_synthetic_tables(conn, coin_count, args.days)
+        coins = ",".join(f"coin_{c}" for c in range(coin_count))
+        timings = {}
+        for label, strategy, storage in (
+            ("joins", "joins", "per_coin"),
+            ("pivot", "pivot", "per_coin"),
+            ("pivot_long", "pivot", "long"),
+        ):
+            sql = render_model(model_source, {
+                "coins": coins,
+                "denorm_all_coins_strategy": strategy,
+                "coin_storage": storage,
+            })
+            timings[label] = time_build(conn, sql, f"out_{label}")
+
+        if timings["joins"] is None or timings["pivot"] is None:
+            same = "n/a"
+        else:
+            differing = conn.execute("""
+                SELECT count(*) FROM (
+                    (SELECT * FROM out_joins EXCEPT SELECT * FROM out_pivot)
+                    UNION ALL
+                    (SELECT * FROM out_pivot EXCEPT SELECT * FROM out_joins)
+                )
+            """).fetchone()[0]
+            same = "yes" if differing == 0 else f"no ({differing} rows differ)"
+        print(
+            f"{coin_count:>6} {format_timing(timings['joins'], 10)} {format_timing(timings['pivot'], 10)} "
+            f"{format_timing(timings['pivot_long'], 11)}  {same}"
+        )
+        for c in range(coin_count):
+            conn.execute(f"DROP TABLE denorm_coin_{c}_history")
+
+
+if __name__ == "__main__":
+    main()
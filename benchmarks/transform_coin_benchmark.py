@@ -0,0 +1,124 @@
+"""
+Benchmark the transform_coin macro on a synthetic multi-year hourly
+market_chart payload, comparing the previous per-element json_extract
+implementation with the current one in coindbt/macros/transform_coin.sql.
+
+Usage:
+    python benchmarks/transform_coin_benchmark.py --years 2
+"""
+import argparse
+import json
+import os
+import time
+
+import duckdb
+from jinja2 import Environment
+
+MACRO_PATH = os.path.join(os.path.dirname(__file__), "..", "coindbt", "macros", "transform_coin.sql")
+
+# The implementation this benchmark was written against: an index array plus
+# one json_extract per element and column, deduplicated by window functions.
+PREVIOUS_MACRO = """
+{% macro transform_coin(coin_name) %}
+  WITH raw AS (
+      SELECT *
+      FROM {{ source("warehouse_" ~ coin_name, "market_chart") }}
+  ),
+  with_indexes AS (
+      SELECT
+          raw.*,
+          range(CAST(0 AS BIGINT), CAST(json_array_length(prices) - 1 AS BIGINT)) AS idx_array
+      FROM raw
+  ),
+  transformed AS (
+      SELECT
+          timestamp 'epoch'
+            + ((json_extract(prices, '$[' || t.idx || '][0]')::BIGINT / 1000)::BIGINT * interval '1 second') AS date,
+          json_extract(prices, '$[' || t.idx || '][1]')::DOUBLE AS price,
+          json_extract(market_caps, '$[' || t.idx || '][1]')::DOUBLE AS market_cap,
+          json_extract(total_volumes, '$[' || t.idx || '][1]')::DOUBLE AS total_volume
+      FROM with_indexes
+      CROSS JOIN UNNEST(idx_array) AS t(idx)
+  ),
+  dedup AS (
+      SELECT
+          date,
+          first_value(price) OVER (PARTITION BY date ORDER BY date) AS price,
+          first_value(market_cap) OVER (PARTITION BY date ORDER BY date) AS market_cap,
+          first_value(total_volume) OVER (PARTITION BY date ORDER BY date) AS total_volume,
+          row_number() OVER (PARTITION BY date ORDER BY date) AS rn
+      FROM transformed
+  )
+  SELECT date, price, market_cap, total_volume
+  FROM dedup
+  WHERE rn = 1
+{% endmacro %}
+"""
+
+
+def render_macro(macro_source, table):
+    """Render transform_coin with source() pointing at a plain table."""
+    env = Environment()
+    env.globals["source"] = lambda source_name, table_name: table
+    return env.from_string(macro_source + "{{ transform_coin('benchmark') }}").render()
+
+
+def synthetic_payload(years):
+    """Hourly [timestamp_ms, value] points covering ``years`` years."""
+    start_ms = 1_600_000_000_000
+    points = int(years * 365 * 24)
+    prices = [[start_ms + i * 3_600_000, 10_000 + (i % 977) * 0.5] for i in range(points)]
+    market_caps = [[ts, price * 19_000_000] for ts, price in prices]
+    total_volumes = [[ts, price * 1_000] for ts, price in prices]
+    return prices, market_caps, total_volumes
+
+
+def time_query(conn, sql, repeat):
+    best = None
+    rows = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = conn.execute(f"SELECT count(*), sum(price) FROM ({sql})").fetchone()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the transform_coin macro")
+    parser.add_argument("--years", type=float, default=2, help="Years of hourly points in the payload")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per implementation; the best is reported")
+    parser.add_argument("--skip-previous", action="store_true",
+                        help="Only time the current macro (the previous one is quadratic in the payload size)")
+    args = parser.parse_args()
+
+    prices, market_caps, total_volumes = synthetic_payload(args.years)
+    conn = duckdb.connect()
+    conn.execute(
+        "CREATE TABLE market_chart AS SELECT ?::VARCHAR AS prices, ?::VARCHAR AS market_caps, ?::VARCHAR AS total_volumes",
+        (json.dumps(prices), json.dumps(market_caps), json.dumps(total_volumes))
+    )
+    print(f"Payload: {len(prices)} hourly points ({args.years:g} years)")
+
+    with open(MACRO_PATH) as f:
+        current_sql = render_macro(f.read(), "market_chart")
+    current_time, current_rows = time_query(conn, current_sql, args.repeat)
+    print(f"current : {current_time:8.3f}s  rows={current_rows[0]}")
+
+    if not args.skip_previous:
+        previous_sql = render_macro(PREVIOUS_MACRO, "market_chart")
+        try:
+            previous_time, previous_rows = time_query(conn, previous_sql, 1)
+        except duckdb.Error as e:
+            # Each json_extract materializes a copy of the document, so large
+            # payloads can exhaust memory before they finish.
+            print(f"previous: failed ({type(e).__name__}: {str(e).splitlines()[0]})")
+            return
+        print(f"previous: {previous_time:8.3f}s  rows={previous_rows[0]}")
+        if previous_rows != current_rows:
+            print(f"WARNING: results differ: previous={previous_rows} current={current_rows}")
+        print(f"speedup : {previous_time / current_time:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,12 @@
 from crewai import Agent
 from crewai.tools import BaseTool
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import itertools
+import os
+import threading
+import time
 from coin_crew.llm_config import openai_gpt4,  ollama_llama2, openai_gpt35, bedrock_llm
 from typing import Dict, List, Optional
 from pydantic import  BaseModel, PrivateAttr
@@ -20,6 +26,119 @@ class CreateQueryToolSchema(BaseModel):
 class FetchQueryResultToolSchema(BaseModel):
     query_id: str
 
+# ============================
+# MCP CLIENT
+# ============================
+# Defaults for MCPClient; override per client through MCPClient.for_url(url, ...)
+MCP_CONNECT_TIMEOUT = float(os.environ.get("MCP_CONNECT_TIMEOUT", "5"))
+MCP_READ_TIMEOUT = float(os.environ.get("MCP_READ_TIMEOUT", "300"))
+MCP_RETRIES = int(os.environ.get("MCP_RETRIES", "3"))
+MCP_METRICS_TTL = float(os.environ.get("MCP_METRICS_TTL", "300"))
+
+
+class MCPClient:
+    """
+    JSON-RPC client for the MCP HTTP wrapper, shared by all tools pointing at
+    the same URL: one pooled keep-alive requests.Session, unique request ids,
+    connect/read timeouts, retries with backoff on connection errors and
+    502/503/504, and a TTL memo of the (rarely changing) metrics catalog.
+    A request that times out waiting for its response is not resent: the
+    server may still be running it.
+    """
+    _clients = {}
+    _clients_lock = threading.Lock()
+
+    @classmethod
+    def for_url(cls, mcp_url: str, **options) -> "MCPClient":
+        """The shared client for a URL and options (timeout, retries, metrics_ttl)."""
+        key = (mcp_url, tuple(sorted(options.items())))
+        with cls._clients_lock:
+            if key not in cls._clients:
+                cls._clients[key] = cls(mcp_url, **options)
+            return cls._clients[key]
+
+    def __init__(self, mcp_url: str, timeout=None, retries: Optional[int] = None, metrics_ttl: Optional[float] = None):
+        timeout = timeout if timeout is not None else (MCP_CONNECT_TIMEOUT, MCP_READ_TIMEOUT)
+        retries = retries if retries is not None else MCP_RETRIES
+        metrics_ttl = metrics_ttl if metrics_ttl is not None else MCP_METRICS_TTL
+        self.mcp_url = mcp_url
+        self.timeout = timeout
+        self.metrics_ttl = metrics_ttl
+        self._ids = itertools.count(1)
+        self._session = requests.Session()
+        self._session.headers.update({"Content-Type": "application/json"})
+        adapter = HTTPAdapter(
+            pool_maxsize=16,
+            max_retries=Retry(
+                total=retries,
+                connect=retries,
+                read=0,
+                status=retries,
+                other=0,
+                backoff_factor=0.5,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=None,  # POST is resent on connect errors and 502/503/504 only, never after a read timeout
+            ),
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._metrics_memo = {}  # json(arguments) -> (fetched_at, result)
+        self._metrics_lock = threading.Lock()
+
+    def call_tool(self, name: str, arguments: dict) -> dict:
+        """Call an MCP tool and return its decoded JSON text content."""
+        payload = {
+            "jsonrpc": "2.0",
+            "id": next(self._ids),
+            "method": "tools/call",
+            "params": {"name": name, "arguments": arguments}
+        }
+        response = self._session.post(self.mcp_url, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        body = response.json()
+        if "error" in body:
+            raise RuntimeError(body["error"].get("message", body["error"]))
+        content = body.get("result", {}).get("content", [{}])[0]
+        if "text" not in content:
+            raise ValueError(f"'text' field missing in response content: {content}")
+        return json.loads(content["text"])
+
+    def fetch_metrics(self, **arguments) -> dict:
+        """
+        All pages of fetch_metrics for the given filters, merged into
+        {"metrics": [...], "dimensionSets": {...}} and memoized for metrics_ttl seconds.
+        """
+        key = json.dumps(arguments, sort_keys=True)
+        with self._metrics_lock:
+            memo = self._metrics_memo.get(key)
+            if memo and time.monotonic() - memo[0] < self.metrics_ttl:
+                return memo[1]
+
+        merged = {"metrics": [], "dimensionSets": {}}
+        cursor = None
+        restarted = False
+        while True:
+            try:
+                page = self.call_tool("fetch_metrics", {**arguments, **({"cursor": cursor} if cursor else {})})
+            except RuntimeError as e:
+                # The catalog was rebuilt between pages: list it again from the start, once
+                if not cursor or restarted or "catalog changed" not in str(e):
+                    raise
+                merged = {"metrics": [], "dimensionSets": {}}
+                cursor = None
+                restarted = True
+                continue
+            merged["metrics"].extend(page.get("metrics", []))
+            merged["dimensionSets"].update(page.get("dimensionSets", {}))
+            cursor = page.get("nextCursor")
+            if not cursor:
+                break
+
+        with self._metrics_lock:
+            self._metrics_memo[key] = (time.monotonic(), merged)
+        return merged
+
+
 # ============================
 # TOOLS
 # ============================
@@ -29,29 +148,11 @@ class FetchMetricsTool(BaseTool):
 
     def __init__(self, mcp_url: str):
         super().__init__()
-        self._mcp_url = mcp_url
-        self._headers = {"Content-Type": "application/json"}
+        self._client = MCPClient.for_url(mcp_url)
 
     def _run(self):
-        payload = {
-            "jsonrpc": "2.0",
-            "id": 2,
-            "method": "tools/call",
-            "params": {"name": "fetch_metrics", "arguments": {}}
-        }
-
         try:
-            response = requests.post(self._mcp_url, json=payload, headers=self._headers)
-            response.raise_for_status()
-            result = response.json().get("result", {}).get("content", [{}])[0]
-            text_content = result.get("text")
-
-            if not text_content:
-                return {"error": "'text' field missing in response content"}
-
-            parsed = json.loads(text_content)
-            return {"metrics": parsed.get("metrics", [])}
-
+            return self._client.fetch_metrics()
         except Exception as e:
             return {"error": f"[FetchMetricsTool] Error: {e}"}
 
@@ -63,8 +164,7 @@ class CreateQueryTool(BaseTool):
 
     def __init__(self, mcp_url: str):
         super().__init__()
-        self._mcp_url = mcp_url
-        self._headers = {"Content-Type": "application/json"}
+        self._client = MCPClient.for_url(mcp_url)
 
     def format_list_to_name_only(self, items: Optional[List]) -> List[Dict[str, str]]:
             """
@@ -103,29 +203,16 @@ class CreateQueryTool(BaseTool):
         formatted_groupBy = self.format_list_to_name_only(groupBy)
         formatted_orderBy = self.format_list_to_name_only(orderBy)
 
-        payload = {
-            "jsonrpc": "2.0",
-            "id": 4,
-            "method": "tools/call",
-            "params": {
-                "name": "create_query",
-                "arguments": {
-                    "metrics": formatted_metrics,
-                    "groupBy": groupBy or [],
-                    #"where": where or [],
-                    #"limit": limit,
-                    "orderBy": orderBy or []
-                }
-            }
+        arguments = {
+            "metrics": formatted_metrics,
+            "groupBy": groupBy or [],
+            #"where": where or [],
+            #"limit": limit,
+            "orderBy": orderBy or []
         }
 
         try:
-            response = requests.post(self._mcp_url, json=payload, headers=self._headers)
-            response.raise_for_status()
-            content = response.json().get("result", {}).get("content", [{}])[0]
-            if "text" in content:
-                return json.loads(content["text"])
-            return {"error": "[CreateQueryTool] Unexpected response format", "raw_response": content}
+            return self._client.call_tool("create_query", arguments)
         except Exception as e:
             return {"error": f"[CreateQueryTool] Error: {e}"}
             
@@ -137,30 +224,11 @@ class FetchQueryResultTool(BaseTool):
 
     def __init__(self, mcp_url: str):
         super().__init__()
-        self._mcp_url = mcp_url
-        self._headers = {"Content-Type": "application/json"}
+        self._client = MCPClient.for_url(mcp_url)
 
     def _run(self, query_id: str):
-        payload = {
-            "jsonrpc": "2.0",
-            "id": 5,
-            "method": "tools/call",
-            "params": {
-                "name": "fetch_query_result",
-                "arguments": {"queryId": query_id}
-            }
-        }
-
         try:
-            response = requests.post(self._mcp_url, json=payload, headers=self._headers)
-            response.raise_for_status()
-
-            # Extract and decode the inner result
-            raw_text = response.json().get("result", {}).get("content", [{}])[0].get("text", "")
-            if not raw_text:
-                return {"error": "[FetchQueryResultTool] No text field in response content"}
-
-            parsed = json.loads(raw_text)
+            parsed = self._client.call_tool("fetch_query_result", {"queryId": query_id})
             return {
                 "status": parsed.get("status"),
                 "results": parsed.get("results", []),
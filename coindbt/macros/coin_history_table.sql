@@ -1,3 +1,7 @@
 {% macro coin_history_table(coin) -%}
+    {%- if var('coin_storage', 'per_coin') == 'long' -%}
+    (select * from coin_history where coin = '{{ coin }}')
+    {%- else -%}
     {{ coin }}_history
+    {%- endif -%}
 {%- endmacro %}
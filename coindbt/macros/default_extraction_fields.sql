@@ -0,0 +1,24 @@
+{% macro default_extraction_fields() -%}
+    {#
+        With var('typed_history') the history tables carry typed columns written
+        by `fetch_coin_history.py --typed-columns`, so fields are read directly
+        instead of re-parsing the JSON payloads on every run.
+    #}
+    {%- if var('typed_history', false) -%}
+    {{ return({
+        "current_price_usd": "current_price_usd",
+        "market_cap_usd": "market_cap_usd",
+        "forks": "forks",
+        "stars": "stars",
+        "alexa_rank": "alexa_rank"
+    }) }}
+    {%- else -%}
+    {{ return({
+        "current_price_usd": "try_cast(json_extract(market_data, '$.current_price.usd') as DOUBLE)",
+        "market_cap_usd": "try_cast(json_extract(market_data, '$.market_cap.usd') as DOUBLE)",
+        "forks": "try_cast(json_extract(developer_data, '$.forks') as INTEGER)",
+        "stars": "try_cast(json_extract(developer_data, '$.stars') as INTEGER)",
+        "alexa_rank": "try_cast(json_extract(public_interest_stats, '$.alexa_rank') as INTEGER)"
+    }) }}
+    {%- endif -%}
+{%- endmacro %}
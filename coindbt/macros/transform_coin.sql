@@ -1,34 +1,37 @@
 {% macro transform_coin(coin_name) %}
+  {#
+    Each JSON array is parsed once into DOUBLE[][] and unnested in lockstep,
+    instead of one json_extract per element (which re-parsed the whole
+    document every time). The trailing point (the live, not yet closed
+    price) is dropped as before. market_chart keeps one row per fetched
+    span and refreshes add overlapping spans, so a day present in several
+    rows takes its values from the most recently fetched one.
+  #}
   WITH raw AS (
-      SELECT *
+      SELECT
+          CAST(CAST(prices AS JSON) AS DOUBLE[][]) AS prices,
+          CAST(CAST(market_caps AS JSON) AS DOUBLE[][]) AS market_caps,
+          CAST(CAST(total_volumes AS JSON) AS DOUBLE[][]) AS total_volumes,
+          fetched_at,
+          range_end
       FROM {{ source("warehouse_" ~ coin_name, "market_chart") }}
   ),
-  with_indexes AS (
+  points AS (
       SELECT
-          raw.*,
-          range(CAST(0 AS BIGINT), CAST(json_array_length(prices) - 1 AS BIGINT)) AS idx_array
+          unnest(prices[1:len(prices) - 1]) AS price_point,
+          unnest(market_caps[1:len(prices) - 1]) AS market_cap_point,
+          unnest(total_volumes[1:len(prices) - 1]) AS total_volume_point,
+          fetched_at,
+          range_end
       FROM raw
-  ),
-  transformed AS (
-      SELECT
-          timestamp 'epoch'
-            + ((json_extract(prices, '$[' || t.idx || '][0]')::BIGINT / 1000)::BIGINT * interval '1 second') AS date,
-          json_extract(prices, '$[' || t.idx || '][1]')::DOUBLE AS price,
-          json_extract(market_caps, '$[' || t.idx || '][1]')::DOUBLE AS market_cap,
-          json_extract(total_volumes, '$[' || t.idx || '][1]')::DOUBLE AS total_volume
-      FROM with_indexes
-      CROSS JOIN UNNEST(idx_array) AS t(idx)
-  ),
-  dedup AS (
-      SELECT
-          date,
-          first_value(price) OVER (PARTITION BY date ORDER BY date) AS price,
-          first_value(market_cap) OVER (PARTITION BY date ORDER BY date) AS market_cap,
-          first_value(total_volume) OVER (PARTITION BY date ORDER BY date) AS total_volume,
-          row_number() OVER (PARTITION BY date ORDER BY date) AS rn
-      FROM transformed
   )
-  SELECT date, price, market_cap, total_volume
-  FROM dedup
-  WHERE rn = 1
+  SELECT
+      timestamp 'epoch'
+        + ((CAST(price_point[1] AS BIGINT) / 1000)::BIGINT * interval '1 second') AS date,
+      price_point[2] AS price,
+      market_cap_point[2] AS market_cap,
+      total_volume_point[2] AS total_volume
+  FROM points
+  WHERE price_point IS NOT NULL
+  QUALIFY row_number() OVER (PARTITION BY date ORDER BY fetched_at DESC, range_end DESC) = 1
 {% endmacro %}
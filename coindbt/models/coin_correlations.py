@@ -1,104 +1,357 @@
+import itertools
+import warnings
+
+import numpy as np
+import pandas as pd
+
+KEY_COLUMNS = ["coin1", "coin2", "measure", "time_period_type", "time_period"]
+PAIR_COLUMNS = ["coin1", "coin2", "measure"]
+# Co-moments of a coin pair over the rows where both coins have a value:
+# count, means, sums of squared deviations and sum of cross-deviations.
+STAT_COLUMNS = ["n", "mean_x", "mean_y", "m2_x", "m2_y", "c_xy"]
+OUTPUT_COLUMNS = ["coin1", "coin2", "correlation", "measure", "time_period_type", "time_period"] \
+    + STAT_COLUMNS + ["source_checksum"]
+
+
+def log_returns(prices):
+    """Day-over-day log returns; NaN where either price is missing or not positive."""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        logs = np.where(prices > 0, np.log(prices), np.nan)
+    returns = np.full_like(prices, np.nan)
+    returns[1:] = logs[1:] - logs[:-1]
+    return returns
+
+
+def quarter_keys(dates):
+    """year * 10 + quarter of each datetime64[D] date."""
+    return (dates.astype("datetime64[Y]").astype(int) + 1970) * 10 \
+        + (dates.astype("datetime64[M]").astype(int) % 12) // 3 + 1
+
+
+def arrow_matrix(batch, n_coins):
+    """
+    Dates and a rows x coins float matrix from an Arrow record batch or table
+    of (date, price columns...). Null-free columns come out of Arrow as
+    NumPy views; the matrix is column-major so the products in pair_moments
+    read it contiguously.
+    """
+    dates = batch.column(0).to_numpy(zero_copy_only=False)
+    prices = np.empty((batch.num_rows, n_coins), order="F")
+    for k in range(n_coins):
+        prices[:, k] = batch.column(k + 1).to_numpy(zero_copy_only=False)
+    return dates, prices
+
+
+def stream_quarters(reader, n_coins):
+    """
+    Yield (quarter_key, prices, log_returns) for each calendar quarter of a
+    date-ordered Arrow record batch reader, holding at most one quarter plus
+    one batch in memory. The row preceding each quarter is carried over so
+    the quarter's first log return can be computed.
+    """
+    dates = np.empty(0, dtype="datetime64[D]")
+    prices = np.empty((0, n_coins))
+    previous = None
+    for batch in itertools.chain(reader, [None]):
+        if batch is not None:
+            batch_dates, batch_prices = arrow_matrix(batch, n_coins)
+            dates = np.concatenate([dates, batch_dates])
+            prices = np.concatenate([prices, batch_prices])
+        keys = quarter_keys(dates)
+        # Until the reader is exhausted the last quarter may continue in the next batch.
+        done = len(keys) if batch is None or not len(keys) else np.searchsorted(keys, keys[-1])
+        start = 0
+        while start < done:
+            end = np.searchsorted(keys, keys[start], side="right")
+            block = prices[start:end]
+            returns = log_returns(block if previous is None else np.vstack([previous, block]))
+            yield int(keys[start]), block, returns[len(returns) - len(block):]
+            previous = block[-1:].copy()
+            start = end
+        dates, prices = dates[done:], prices[done:]
+
+
+def pair_moments(values, upper_i, upper_j):
+    """
+    Pairwise-complete co-moments (STAT_COLUMNS) of the coin pairs
+    (upper_i, upper_j) over the rows of ``values`` (rows x coins, NaN =
+    missing), from four matrix products. Columns are shifted by their mean
+    first so the sums of squares do not cancel for large, slowly-moving prices.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN columns
+        shift = np.nan_to_num(np.nanmean(values, axis=0)) if len(values) else np.zeros(values.shape[1])
+    present = ~np.isnan(values)
+    mask = present.astype(np.float64)
+    x = np.where(present, values - shift, 0.0)
+
+    n = (mask.T @ mask)[upper_i, upper_j]
+    sums = x.T @ mask  # (i, j): sum of coin i over rows where coin j is present too
+    squares = (x * x).T @ mask
+    sum_x, sum_y = sums[upper_i, upper_j], sums[upper_j, upper_i]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_x = np.where(n > 0, sum_x / n, 0.0)
+        mean_y = np.where(n > 0, sum_y / n, 0.0)
+    return {
+        "n": n,
+        "mean_x": mean_x + shift[upper_i],
+        "mean_y": mean_y + shift[upper_j],
+        "m2_x": squares[upper_i, upper_j] - sum_x * mean_x,
+        "m2_y": squares[upper_j, upper_i] - sum_y * mean_y,
+        "c_xy": (x.T @ x)[upper_i, upper_j] - sum_x * mean_y,
+    }
+
+
+def combine_groups(frame, keys):
+    """Merge the co-moments of disjoint row sets (e.g. the quarters of a year) per ``keys``."""
+    frame = frame.assign(wx=frame["n"] * frame["mean_x"], wy=frame["n"] * frame["mean_y"])
+    grouped = frame.groupby(keys, sort=False)
+    n = grouped["n"].transform("sum")
+    with np.errstate(invalid="ignore", divide="ignore"):
+        dx = frame["mean_x"] - (grouped["wx"].transform("sum") / n).fillna(0.0)
+        dy = frame["mean_y"] - (grouped["wy"].transform("sum") / n).fillna(0.0)
+    frame = frame.assign(
+        m2_x=frame["m2_x"] + frame["n"] * dx * dx,
+        m2_y=frame["m2_y"] + frame["n"] * dy * dy,
+        c_xy=frame["c_xy"] + frame["n"] * dx * dy,
+    )
+    out = frame.groupby(keys, sort=False, as_index=False)[["n", "wx", "wy", "m2_x", "m2_y", "c_xy"]].sum()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out["mean_x"] = np.where(out["n"] > 0, out["wx"] / out["n"], 0.0)
+        out["mean_y"] = np.where(out["n"] > 0, out["wy"] / out["n"], 0.0)
+    return out.drop(columns=["wx", "wy"])
+
+
+def update_moments(total, part, sign):
+    """
+    Add (sign=1) the co-moments of a disjoint row set ``part`` to ``total``,
+    or take them out again (sign=-1, ``part`` must be a subset of ``total``).
+    Frames are matched on PAIR_COLUMNS; pairs missing on one side count as empty.
+    """
+    aligned = total.merge(part, on=PAIR_COLUMNS, how="outer", suffixes=("", "_part")).fillna(0.0)
+    n_total, n_part = aligned["n"], aligned["n_part"]
+    n = n_total + sign * n_part
+    # The cross term uses the part's mean against the mean of the other
+    # rows, weighted by n_other * n_part / n_union.
+    n_other, n_union = (n_total, n) if sign > 0 else (n, n_total)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_x = np.where(n > 0, (n_total * aligned["mean_x"] + sign * n_part * aligned["mean_x_part"]) / n, 0.0)
+        mean_y = np.where(n > 0, (n_total * aligned["mean_y"] + sign * n_part * aligned["mean_y_part"]) / n, 0.0)
+        weight = np.where(n_union > 0, n_other * n_part / n_union, 0.0)
+    dx = aligned["mean_x_part"] - (aligned["mean_x"] if sign > 0 else mean_x)
+    dy = aligned["mean_y_part"] - (aligned["mean_y"] if sign > 0 else mean_y)
+    keep = n > 0
+    return pd.DataFrame({
+        **{c: aligned[c] for c in PAIR_COLUMNS},
+        "n": n,
+        "mean_x": mean_x,
+        "mean_y": mean_y,
+        "m2_x": np.where(keep, aligned["m2_x"] + sign * (aligned["m2_x_part"] + dx * dx * weight), 0.0),
+        "m2_y": np.where(keep, aligned["m2_y"] + sign * (aligned["m2_y_part"] + dy * dy * weight), 0.0),
+        "c_xy": np.where(keep, aligned["c_xy"] + sign * (aligned["c_xy_part"] + dx * dy * weight), 0.0),
+    })
+
+
+def with_correlation(frame):
+    """Add the Pearson correlation implied by the co-moments (NaN where undefined)."""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        corr = frame["c_xy"] / np.sqrt(frame["m2_x"] * frame["m2_y"])
+    undefined = (frame["n"] < 2) | (frame["m2_x"] <= 0) | (frame["m2_y"] <= 0)
+    return frame.assign(correlation=corr.where(~undefined).clip(-1.0, 1.0))
+
+
+def quarter_label(quarter_key):
+    year, quarter = divmod(int(quarter_key), 10)
+    return f"{year}Q{quarter}"
+
+
 def model(dbt, session):
     """
     This Python model will:
     1) Load coin data from denorm_all_coins
     2) Only select columns named *_current_price_usd
-    3) Compute correlation for:
-       - overall (all rows)
+    3) Compute Pearson correlations of price levels and of daily log returns for:
+       - overall (time_period 'all')
        - yearly
        - quarterly
-    4) Return a long-format correlation table with:
-       coin1, coin2, correlation, time_period_type, time_period
+       - trailing rolling windows (rolling_windows days) ending every
+         rolling_step_days over the last rolling_lookback_days days
+    4) Return a long-format correlation table (upper triangle only) with:
+       coin1, coin2, correlation, measure, time_period_type, time_period,
+       plus the pair's co-moments (STAT_COLUMNS) and, on quarterly rows, a
+       checksum of the source rows of that quarter
+
+    Quarters are computed from the source in one NumPy pass each; years and
+    "overall" are merged from quarter co-moments. Incremental runs compare the
+    per-quarter source checksums with the stored ones, read only quarters that
+    changed (new days, refreshed or backfilled dates), and update their years
+    and "overall" from the stored co-moments instead of rescanning history.
+    Pairs of coins removed from the source are deleted, a new coin triggers a
+    rebuild of every period, and rolling windows are replaced on every run.
     """
-    import pandas as pd
-    
-    # 1) Load the table
-    df = dbt.ref("denorm_all_coins").to_df()
-    
-    date_col = "date"
-    # Convert to datetime if needed
-    df[date_col] = pd.to_datetime(df[date_col], errors="coerce")
+    dbt.config(
+        materialized="incremental",
+        incremental_strategy="delete+insert",
+        unique_key=KEY_COLUMNS,
+        rolling_windows=[30, 90],
+        rolling_step_days=7,
+        rolling_lookback_days=90,
+        arrow_batch_rows=512,
+    )
+    rolling_windows = dbt.config.get("rolling_windows") or []
+    rolling_step_days = dbt.config.get("rolling_step_days") or 7
+    rolling_lookback_days = dbt.config.get("rolling_lookback_days") or 0
+    arrow_batch_rows = dbt.config.get("arrow_batch_rows") or 512
+
+    # 1) The source relation; rows are streamed into Python quarter by quarter below
+    source = dbt.ref("denorm_all_coins")
 
     # 2) Identify only the columns that end with '_current_price_usd'
     price_cols = [
-        c for c in df.columns 
+        c for c in source.columns
         if c.endswith("_current_price_usd")
     ]
+    upper_i, upper_j = np.triu_indices(len(price_cols), k=1)
+    coin1 = np.asarray(price_cols, dtype=object)[upper_i]
+    coin2 = np.asarray(price_cols, dtype=object)[upper_j]
 
-    # Build a numeric dataframe with only these price columns
-    df_price_only = df[price_cols]
-
-    # ----------------------------
-    # A helper to convert a correlation matrix to long format
-    # with additional fields
-    # ----------------------------
-    def corr_matrix_to_long(corr_matrix, time_period_type, time_period):
-        corr_long = corr_matrix.reset_index().melt(
-            id_vars='index',
-            var_name='coin2',
-            value_name='correlation'
-        )
-        corr_long.rename(columns={'index': 'coin1'}, inplace=True)
-        corr_long["time_period_type"] = time_period_type
-        corr_long["time_period"] = time_period
-        return corr_long
-    
-    # ----------------------------
-    # 3A) Overall correlation
-    # ----------------------------
-    overall_corr = df_price_only.corr()  # By default, Pearson correlation
-    overall_long = corr_matrix_to_long(
-        overall_corr,
-        time_period_type="overall",
-        time_period=None
+    # Per-quarter checksums of the source, computed inside DuckDB.
+    quarter_expr = "year(date) * 10 + quarter(date)"
+    checksums = dict(source.aggregate(
+        f"{quarter_expr} AS quarter_key, "
+        f"CAST(bit_xor(hash(date, {', '.join(price_cols)})) AS VARCHAR) AS source_checksum",
+        quarter_expr
+    ).fetchall()) if price_cols else {}
+
+    incremental = dbt.is_incremental
+    if incremental:
+        # delete+insert only replaces keys that are emitted again, so rows of
+        # coins that left the source and of rolling end dates that moved out
+        # of the lookback are deleted here; rolling windows are recomputed
+        # below on every run.
+        stored_coins = {row[0] for row in session.sql(
+            f"SELECT coin1 FROM {dbt.this} UNION SELECT coin2 FROM {dbt.this}"
+        ).fetchall()}
+        removed = ", ".join(f"'{coin}'" for coin in sorted(stored_coins - set(price_cols)))
+        if removed:
+            session.execute(f"DELETE FROM {dbt.this} WHERE coin1 IN ({removed}) OR coin2 IN ({removed})")
+        session.execute(f"DELETE FROM {dbt.this} WHERE time_period_type LIKE 'rolling%'")
+        # A new coin adds pairs to every period: rebuild them all.
+        incremental = set(price_cols) <= stored_coins
+    if incremental:
+        stored_checksums = dict(session.sql(
+            f"SELECT DISTINCT time_period, source_checksum FROM {dbt.this} "
+            f"WHERE time_period_type = 'quarterly'"
+        ).fetchall())
+        touched = sorted(q for q, checksum in checksums.items()
+                         if stored_checksums.get(quarter_label(q)) != checksum)
+    else:
+        touched = sorted(checksums)
+    touched_labels = ", ".join(f"'{quarter_label(q)}'" for q in touched)
+
+    def stored(where):
+        return session.sql(
+            f"SELECT {', '.join(KEY_COLUMNS + STAT_COLUMNS)} FROM {dbt.this} WHERE {where}"
+        ).df()
+
+    # Only the date and price columns leave DuckDB, as typed Arrow batches.
+    projection = ", ".join(
+        ["CAST(date AS DATE) AS date"] + [f"CAST({c} AS DOUBLE) AS {c}" for c in price_cols]
     )
 
-    # ----------------------------
-    # 3B) Yearly correlation
-    # ----------------------------
-    # Extract year from date
-    df["year"] = df[date_col].dt.year
-    yearly_results = []
-
-    for year_val, group_df in df.groupby("year"):
-        # Build numeric subset for that year
-        group_numeric = group_df[price_cols]
-        corr_mat = group_numeric.corr()
-        
-        # Convert wide correlation matrix to long
-        corr_long = corr_matrix_to_long(
-            corr_mat,
-            time_period_type="yearly",
-            time_period=str(year_val)  # e.g. "2024"
-        )
-        yearly_results.append(corr_long)
-
-    yearly_long = pd.concat(yearly_results, ignore_index=True) if yearly_results else pd.DataFrame()
-
-    # ----------------------------
-    # 3C) Quarterly correlation
-    # ----------------------------
-    # Make a "year-quarter" string, e.g. "2024Q1"
-    df["quarter"] = df[date_col].dt.to_period("Q").astype(str)
-    quarterly_results = []
-
-    for q_val, group_df in df.groupby("quarter"):
-        group_numeric = group_df[price_cols]
-        corr_mat = group_numeric.corr()
-        
-        corr_long = corr_matrix_to_long(
-            corr_mat,
-            time_period_type="quarterly",
-            time_period=q_val  # e.g. "2024Q1"
-        )
-        quarterly_results.append(corr_long)
+    def arrow_reader(where):
+        relation = source.filter(where).project(projection).order("date")
+        # Newer DuckDB releases renamed fetch_record_batch() to to_arrow_reader().
+        fetch = getattr(relation, "to_arrow_reader", None) or relation.fetch_record_batch
+        return fetch(arrow_batch_rows)
 
-    quarterly_long = pd.concat(quarterly_results, ignore_index=True) if quarterly_results else pd.DataFrame()
+    def pair_frame(moments, measure, time_period_type, time_period, source_checksum=None):
+        return pd.DataFrame({
+            "coin1": coin1,
+            "coin2": coin2,
+            **moments,
+            "measure": measure,
+            "time_period_type": time_period_type,
+            "time_period": time_period,
+            "source_checksum": source_checksum,
+        })
 
-    # ----------------------------
-    # 4) Combine all
-    # ----------------------------
-    corr_combined = pd.concat([overall_long, yearly_long, quarterly_long], ignore_index=True)
+    frames = []
+    if touched and len(upper_i):
+        # 3A) Quarterly co-moments of the touched quarters. The day before each
+        #     quarter is loaded as well so its first log return exists.
+        reader = arrow_reader(" OR ".join(
+            f"{quarter_expr} = {q} OR date = make_date({q // 10}, {(q % 10 - 1) * 3 + 1}, 1) - INTERVAL 1 DAY"
+            for q in touched
+        ))
+        quarterly = []
+        for q, prices, returns in stream_quarters(reader, len(price_cols)):
+            if q not in touched:
+                continue
+            for measure, values in (("price", prices), ("log_return", returns)):
+                quarterly.append(pair_frame(
+                    pair_moments(values, upper_i, upper_j),
+                    measure, "quarterly", quarter_label(q), checksums[q]
+                ))
+        quarterly = pd.concat(quarterly, ignore_index=True)
+        frames.append(quarterly)
 
-    # Return the final DataFrame
-    return corr_combined
+        # 3B) Yearly: the touched years, merged from all of their quarters.
+        year_quarters = [quarterly]
+        if incremental:
+            year_quarters.append(stored(
+                "time_period_type = 'quarterly' AND left(time_period, 4) IN ({}) AND time_period NOT IN ({})".format(
+                    ", ".join(f"'{year}'" for year in sorted({q // 10 for q in touched})), touched_labels
+                )
+            ))
+        year_quarters = pd.concat(year_quarters, ignore_index=True)
+        year_quarters["time_period"] = year_quarters["time_period"].str[:4]
+        yearly = combine_groups(year_quarters[PAIR_COLUMNS + ["time_period"] + STAT_COLUMNS],
+                                PAIR_COLUMNS + ["time_period"])
+        frames.append(yearly.assign(time_period_type="yearly"))
+
+        # 3C) Overall: the stored running co-moments with the old versions of
+        #     the touched quarters taken out and the new ones added.
+        touched_total = combine_groups(quarterly[PAIR_COLUMNS + STAT_COLUMNS], PAIR_COLUMNS)
+        if incremental:
+            overall = stored("time_period_type = 'overall'")[PAIR_COLUMNS + STAT_COLUMNS]
+            previous = stored(f"time_period_type = 'quarterly' AND time_period IN ({touched_labels})")
+            if len(previous):
+                overall = update_moments(
+                    overall, combine_groups(previous[PAIR_COLUMNS + STAT_COLUMNS], PAIR_COLUMNS), sign=-1
+                )
+            overall = update_moments(overall, touched_total, sign=1)
+        else:
+            overall = touched_total
+        frames.append(overall.assign(time_period_type="overall", time_period="all"))
+
+    # 3D) Trailing rolling windows ending every rolling_step_days days. Only
+    #     recent end dates are kept (older ones were deleted above): the
+    #     output grows with coins squared.
+    if rolling_windows and checksums and len(upper_i):
+        first_date, last_date = source.aggregate("min(date), max(date)").fetchone()
+        first_date = np.datetime64(pd.Timestamp(first_date).date(), "D")
+        span = rolling_lookback_days + max(rolling_windows)
+        dates, prices = arrow_matrix(
+            arrow_reader(f"date >= DATE '{pd.Timestamp(last_date).date()}' - INTERVAL {span} DAY").read_all(),
+            len(price_cols)
+        )
+        measures = {"price": prices, "log_return": log_returns(prices)}
+        first_end_date = dates[-1] - np.timedelta64(rolling_lookback_days, "D")
+        for window in rolling_windows:
+            end_date = dates[-1]
+            while end_date >= first_end_date and end_date - np.timedelta64(window - 1, "D") >= first_date:
+                start = np.searchsorted(dates, end_date - np.timedelta64(window - 1, "D"), side="left")
+                end = np.searchsorted(dates, end_date, side="right")
+                for measure, values in measures.items():
+                    frames.append(pair_frame(
+                        pair_moments(values[start:end], upper_i, upper_j),
+                        measure, f"rolling_{window}d", str(end_date)
+                    ))
+                end_date = end_date - np.timedelta64(rolling_step_days, "D")
+
+    # 4) Combine all
+    if not frames:
+        return pd.DataFrame(columns=OUTPUT_COLUMNS)
+    result = with_correlation(pd.concat(frames, ignore_index=True))
+    return result.reindex(columns=OUTPUT_COLUMNS)
@@ -1,10 +1,64 @@
 {{ config(
-    materialized='table',
+    materialized='incremental',
+    incremental_strategy='delete+insert',
     unique_key='date'
 ) }}
 
 {% set coin_list = var('coins', 'bitcoin,sui').split(',') %}
 
+{#
+    Incremental runs only recompute the last var('denorm_lookback_days') days
+    before the newest date already built, so re-fetched recent days are
+    replaced (delete+insert on date) and cost scales with new days, not with
+    history length. Run with --full-refresh after changing var('coins').
+#}
+{% set lookback_days = var('denorm_lookback_days', 7) %}
+
+{#
+    var('denorm_all_coins_strategy'):
+      joins - one CTE and one LEFT JOIN per coin
+      pivot - one long-format scan pivoted with DuckDB's PIVOT; the plan no
+              longer grows with a join per coin. Same output columns.
+#}
+{% set strategy = var('denorm_all_coins_strategy', 'joins') %}
+{% set long_storage = var('coin_storage', 'per_coin') == 'long' %}
+
+{% if strategy == 'pivot' %}
+
+with coin_data as (
+    {% if long_storage %}
+    select coin, date, current_price_usd, market_cap_usd
+    from {{ ref('denorm_coin_history') }}
+    where true
+    {% if is_incremental() %}
+      and date >= (select max(date) from {{ this }}) - interval '{{ lookback_days }} days'
+    {% endif %}
+    {% else %}
+    {% for coin in coin_list %}
+    select '{{ coin }}' as coin, date, current_price_usd, market_cap_usd
+    from {{ ref('denorm_' ~ coin ~ '_history') }}
+    where true
+    {% if is_incremental() %}
+      and date >= (select max(date) from {{ this }}) - interval '{{ lookback_days }} days'
+    {% endif %}
+    {% if not loop.last %}
+    union all
+    {% endif %}
+    {% endfor %}
+    {% endif %}
+)
+
+select *
+from (
+    pivot coin_data
+    on coin in ({% for coin in coin_list %}'{{ coin }}'{% if not loop.last %}, {% endif %}{% endfor %})
+    using first(current_price_usd) as current_price_usd,
+          first(market_cap_usd) as market_cap_usd
+    group by date
+)
+
+{% else %}
+
 with
 {% for coin in coin_list %}
     {{ coin }} as (
@@ -12,13 +66,27 @@ with
             date,
             current_price_usd as {{ coin }}_current_price_usd,
             market_cap_usd as {{ coin }}_market_cap_usd
+        {% if long_storage %}
+        from {{ ref('denorm_coin_history') }}
+        where coin = '{{ coin }}'
+        {% else %}
         from {{ ref('denorm_' ~ coin ~ '_history') }}
+        where true
+        {% endif %}
+        {% if is_incremental() %}
+          and date >= (select max(date) from {{ this }}) - interval '{{ lookback_days }} days'
+        {% endif %}
     ){% if not loop.last %},{% endif %}
 {% endfor %},
 
+{# Date spine from every coin, so days missing for one coin are not dropped. #}
 base as (
-    select distinct date
-    from {{ coin_list[0] }}
+    {% for coin in coin_list %}
+    select date from {{ coin }}
+    {% if not loop.last %}
+    union
+    {% endif %}
+    {% endfor %}
 )
 
 select
@@ -31,6 +99,5 @@ from base
     {% for coin in coin_list %}
     left join {{ coin }} on base.date = {{ coin }}.date
     {% endfor %}
-{% if is_incremental() %}
-  where base.date > (select max(date) from {{ this }})
+
 {% endif %}
@@ -1,32 +1,21 @@
 {{ config(
     materialized='incremental',
+    incremental_strategy='delete+insert',
     unique_key='date'
 ) }}
 
 {# 
     Pass the coin name as a variable (default: "bitcoin") and the fields to extract as a dictionary.
-    You can override these via the command line or your dbt_project.yml.
+    You can override these via the command line or your dbt_project.yml. The default fields come
+    from default_extraction_fields(): JSON extraction, or typed columns when var('typed_history') is set.
 #}
 {% set coin = var('coin', 'bittorrent') %}
 {% set source_table = coin_history_table(coin) %}
 
-{% set extraction_fields = var('extraction_fields', {
-    "current_price_usd": "try_cast(json_extract(market_data, '$.current_price.usd') as DOUBLE)",
-    "market_cap_usd": "try_cast(json_extract(market_data, '$.market_cap.usd') as DOUBLE)",
-    "forks": "try_cast(json_extract(developer_data, '$.forks') as INTEGER)",
-    "stars": "try_cast(json_extract(developer_data, '$.stars') as INTEGER)",
-    "alexa_rank": "try_cast(json_extract(public_interest_stats, '$.alexa_rank') as INTEGER)"
-}) %}
+{% set extraction_fields = var('extraction_fields', default_extraction_fields()) %}
 
 with source_data as (
-    select
-        date,
-        id,
-        symbol,
-        name,
-        market_data,
-        developer_data,
-        public_interest_stats
+    select *
     from {{ source_table }}
 )
 
@@ -38,5 +27,6 @@ select
     {{ coin_history_fields(extraction_fields) }}
 from source_data
 {% if is_incremental() %}
-    where date > (select max(date) from {{ this }})
+    {# Re-read the lookback window so re-fetched recent days replace the stored ones. #}
+    where date >= (select max(date) from {{ this }}) - interval '{{ var('denorm_lookback_days', 7) }} days'
 {% endif %}
@@ -0,0 +1,51 @@
+{{ config(
+    materialized='incremental',
+    incremental_strategy='delete+insert',
+    unique_key=['coin', 'date']
+) }}
+
+{#
+    Long-format history of every coin, one row per (coin, date), sorted by coin
+    and date so single-coin scans only touch that coin's row groups.
+    With var('coin_storage') = 'long' it reads the shared coin_history table
+    written by `fetch_coin_history.py --storage long`; otherwise it unions the
+    per-coin <coin>_history tables listed in var('coins').
+#}
+{% set coin_list = var('coins', 'bitcoin,sui').split(',') %}
+{% set extraction_fields = var('extraction_fields', default_extraction_fields()) %}
+
+with source_data as (
+{% if var('coin_storage', 'per_coin') == 'long' %}
+    select *
+    from coin_history
+{% else %}
+    {% for coin in coin_list %}
+    select '{{ coin }}' as coin, *
+    from {{ coin_history_table(coin) }}
+    {% if not loop.last %}
+    union all by name
+    {% endif %}
+    {% endfor %}
+{% endif %}
+)
+
+select
+    coin,
+    date,
+    id,
+    symbol,
+    name,
+    {{ coin_history_fields(extraction_fields) }}
+from source_data
+{% if is_incremental() %}
+    {#
+        Per-coin high-water mark minus the lookback window, so re-fetched
+        recent days are replaced and a newly added coin is loaded in full.
+    #}
+    where date >= coalesce(
+        (select max(t.date) from {{ this }} t where t.coin = source_data.coin)
+            - interval '{{ var('denorm_lookback_days', 7) }} days',
+        date '1900-01-01'
+    )
+{% endif %}
+order by coin, date
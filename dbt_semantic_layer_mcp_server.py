@@ -5,9 +5,33 @@ import logging
 import uuid
 import subprocess
 import csv
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 import threading
 import re
+import asyncio
+import contextvars
+import datetime
+import decimal
+import math
+import numbers
+import tempfile
+import time
+import glob
+import hashlib
+import bisect
+import base64
+from collections import OrderedDict
+from pathlib import Path
+
+# MetricFlow's library API, used to keep one query engine warm in-process.
+# Without it, queries fall back to spawning the `mf` CLI.
+try:
+    from dbt_metricflow.cli.dbt_connectors.adapter_backed_client import AdapterBackedSqlClient
+    from dbt_metricflow.cli.dbt_connectors.dbt_config_accessor import dbtArtifacts, dbtProjectMetadata
+    from metricflow.engine.metricflow_engine import MetricFlowEngine, MetricFlowQueryRequest
+    from metricflow_semantics.model.semantic_manifest_lookup import SemanticManifestLookup
+except ImportError:
+    MetricFlowEngine = None
 
 
 logging.basicConfig(
@@ -16,27 +40,379 @@ logging.basicConfig(
     stream=sys.stderr
 )
 
+# JSON-RPC id of the request being handled on the current worker
+current_request_id = contextvars.ContextVar("current_request_id", default=None)
+
+
+#######################################
+# Query result cache
+#######################################
+class QueryResultCache:
+    """
+    Thread-safe LRU cache of query results with a maximum number of entries,
+    a budget on their approximate total size in bytes and a time-to-live.
+    Results larger than the whole budget are not cached. Keys must include
+    the data version so entries computed before new data landed are never
+    served.
+    """
+    def __init__(self, max_entries=128, ttl_seconds=300, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (stored_at, value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    @staticmethod
+    def approximate_size(value):
+        """Encoded length of a result's table, as an estimate of its memory footprint."""
+        return len(json.dumps(value.get("results"), separators=(",", ":"), default=str))
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        size = self.approximate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic(), value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        self._bytes -= self._entries.pop(key)[2]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries,
+                "bytes": self._bytes,
+                "maxBytes": self.max_bytes,
+                "ttlSeconds": self.ttl_seconds,
+            }
+
+
+#######################################
+# Metrics catalog
+#######################################
+# Part of every catalog signature; bump it when entries gain or change
+# fields so a catalog cached by an older version is recomputed, not reused
+CATALOG_FORMAT = 3
+
+
+def build_metrics_catalog(semantic_manifest, descriptions=None, previous=None):
+    """
+    Build [{"name", "description", "dimensions", "timeDimensions",
+    "semanticModels"}] for every metric of a semantic_manifest.json and
+    return it with {metric name: signature}, where
+    the signature hashes the metric's definition and the semantic models its
+    dimensions come from. Entries of a ``previous`` catalog snapshot
+    ({"metrics", "signatures"}) whose signature is unchanged are reused.
+
+    Dimensions are the same group-by names as
+    `mf list dimensions --metrics <name>`:
+
+    - metric_time, when every input measure has an aggregation time dimension
+    - <entity>__<dimension> for the dimensions of the measure's semantic model
+      (through its primary/unique/natural entities) and of the semantic
+      models joinable through one of its entities
+
+    timeDimensions are the dimensions that take a time grain suffix
+    (metric_time and dimensions of type time); semanticModels are the models
+    the metric's measures are defined in.
+
+    A metric's measures are found by resolving derived/ratio inputs
+    recursively; a multi-measure metric supports the dimensions common to
+    all of its measures. Results are memoized per metric, per semantic model
+    and per set of semantic models, since most metrics share their models.
+    """
+    descriptions = descriptions or {}
+    semantic_models = {model["name"]: model for model in semantic_manifest.get("semantic_models", [])}
+    metrics = {metric["name"]: metric for metric in semantic_manifest.get("metrics", [])}
+    identifying = ("primary", "unique", "natural")
+
+    measure_models = {}
+    measure_has_time = {}
+    models_by_entity = {}  # entity name -> semantic models it identifies (join targets)
+    time_dimensions = {"metric_time"}  # group-by names that accept a __<grain> suffix
+    for model in semantic_models.values():
+        default_time = (model.get("defaults") or {}).get("agg_time_dimension")
+        for measure in model.get("measures", []):
+            measure_models[measure["name"]] = model["name"]
+            measure_has_time[measure["name"]] = bool(measure.get("agg_time_dimension") or default_time)
+        for entity in model.get("entities", []):
+            if entity.get("type") in identifying:
+                models_by_entity.setdefault(entity["name"], []).append(model["name"])
+            time_dimensions.update(
+                f"{entity['name']}__{dim['name']}"
+                for dim in model.get("dimensions", []) if dim.get("type") == "time"
+            )
+
+    def own_dimensions(model_name, entity_name):
+        return {f"{entity_name}__{dim['name']}" for dim in semantic_models[model_name].get("dimensions", [])}
+
+    model_dimensions_memo = {}
+
+    def model_dimensions(model_name):
+        """Dimensions reachable from a measure in this semantic model."""
+        if model_name not in model_dimensions_memo:
+            dims = set()
+            for entity in semantic_models[model_name].get("entities", []):
+                if entity.get("type") in identifying:
+                    dims |= own_dimensions(model_name, entity["name"])
+                for other in models_by_entity.get(entity["name"], []):
+                    if other != model_name:
+                        dims |= own_dimensions(other, entity["name"])
+            model_dimensions_memo[model_name] = frozenset(dims)
+        return model_dimensions_memo[model_name]
+
+    measures_memo = {}
+
+    def metric_measures(metric_name, visiting=()):
+        """Names of the measures a metric is ultimately computed from."""
+        if metric_name in measures_memo:
+            return measures_memo[metric_name]
+        metric = metrics.get(metric_name)
+        if metric is None or metric_name in visiting:
+            return frozenset()
+        params = metric.get("type_params") or {}
+        measures = set()
+        for key in ("measure", "base_measure"):
+            if params.get(key):
+                measures.add(params[key]["name"] if isinstance(params[key], dict) else params[key])
+        for key in ("numerator", "denominator"):
+            if params.get(key):
+                name = params[key]["name"] if isinstance(params[key], dict) else params[key]
+                measures |= metric_measures(name, visiting + (metric_name,))
+        for metric_input in params.get("metrics") or []:
+            measures |= metric_measures(metric_input["name"], visiting + (metric_name,))
+        if (params.get("conversion_type_params") or {}).get("base_measure"):
+            measures.add(params["conversion_type_params"]["base_measure"]["name"])
+        if not measures:
+            measures = {m["name"] for m in params.get("input_measures") or []}
+        measures_memo[metric_name] = frozenset(measures)
+        return measures_memo[metric_name]
+
+    common_dimensions_memo = {}
+
+    def common_dimensions(model_names):
+        if model_names not in common_dimensions_memo:
+            dim_sets = [model_dimensions(name) for name in model_names]
+            common_dimensions_memo[model_names] = frozenset.intersection(*dim_sets) if dim_sets else frozenset()
+        return common_dimensions_memo[model_names]
+
+    def definition_hash(obj):
+        return hashlib.sha256(json.dumps(obj, sort_keys=True).encode()).hexdigest()
+
+    model_hashes = {}
+
+    def model_hash(model_name):
+        if model_name not in model_hashes:
+            model_hashes[model_name] = definition_hash(semantic_models[model_name])
+        return model_hashes[model_name]
+
+    previous = previous or {}
+    previous_signatures = previous.get("signatures") or {}
+    previous_entries = {entry["name"]: entry for entry in previous.get("metrics") or []}
+
+    catalog = []
+    signatures = {}
+    reused = 0
+    for metric_name, metric in metrics.items():
+        measures = metric_measures(metric_name)
+        model_names = frozenset(measure_models[m] for m in measures if m in measure_models)
+        related_models = set(model_names)
+        for model_name in model_names:
+            for entity in semantic_models[model_name].get("entities", []):
+                related_models.update(models_by_entity.get(entity["name"], []))
+        description = descriptions.get(metric_name) or metric.get("description") or ""
+        signature = definition_hash([
+            CATALOG_FORMAT, metric, description, [model_hash(name) for name in sorted(related_models)]
+        ])
+        signatures[metric_name] = signature
+
+        if previous_signatures.get(metric_name) == signature and metric_name in previous_entries:
+            catalog.append(previous_entries[metric_name])
+            reused += 1
+            continue
+        dimensions = set(common_dimensions(model_names))
+        if measures and all(measure_has_time.get(m) for m in measures):
+            dimensions.add("metric_time")
+        catalog.append({
+            "name": metric_name,
+            "description": description,
+            "dimensions": sorted(dimensions),
+            "timeDimensions": sorted(dimensions & time_dimensions),
+            "semanticModels": sorted(model_names),
+        })
+    if previous:
+        logging.info(f"Metrics catalog: reused {reused}, recomputed {len(catalog) - reused} metrics.")
+    return catalog, signatures
+
+
+# Time granularities MetricFlow accepts as group-by suffixes (metric_time__month)
+TIME_GRAINS = (
+    "nanosecond", "microsecond", "millisecond", "second", "minute",
+    "hour", "day", "week", "month", "quarter", "year",
+)
+
+
+class CatalogIndex:
+    """
+    Lookup structures over one metrics snapshot, built once per snapshot:
+    metrics by name, each metric's dimensions as a frozenset, the base
+    dimension of every group-by name (itself, or a time dimension with a
+    time grain suffix),
+    an inverted dimension -> metrics index, the sorted metric names (for
+    prefix ranges and pagination) and the distinct dimension sets, which
+    many metrics share.
+    """
+    def __init__(self, metrics):
+        self.metrics_by_name = {m["name"]: m for m in metrics}
+        self.dimensions_by_metric = {m["name"]: frozenset(m["dimensions"]) for m in metrics}
+        self.models_by_metric = {m["name"]: frozenset(m.get("semanticModels", ())) for m in metrics}
+        self.sorted_names = sorted(self.metrics_by_name)
+
+        set_ids = {}
+        self.dimension_sets = []
+        self.dimension_set_of = {}
+        for name in self.sorted_names:
+            dims = self.dimensions_by_metric[name]
+            if dims not in set_ids:
+                set_ids[dims] = str(len(self.dimension_sets))
+                self.dimension_sets.append(sorted(dims))
+            self.dimension_set_of[name] = set_ids[dims]
+
+        metrics_by_dimension = {}
+        for m in metrics:
+            for dim in m["dimensions"]:
+                metrics_by_dimension.setdefault(dim, []).append(m["name"])
+        self.metrics_by_dimension = {dim: frozenset(names) for dim, names in metrics_by_dimension.items()}
+
+        self.base_dimension = {dim: dim for dim in self.metrics_by_dimension}
+        for m in metrics:
+            for dim in m.get("timeDimensions", ()):
+                for grain in TIME_GRAINS:
+                    self.base_dimension.setdefault(f"{dim}__{grain}", dim)
+
+    def dimensions_for_metric(self, metric_name):
+        return self.dimensions_by_metric.get(metric_name, frozenset())
+
+    def supports(self, metric_name, group_by):
+        """Whether a metric can be grouped by a dimension name (optionally with a time grain suffix)."""
+        return self.base_dimension.get(group_by) in self.dimensions_for_metric(metric_name)
+
+    def metrics_for_dimension(self, group_by):
+        """Metrics that can be grouped by a dimension name (optionally with a time grain suffix)."""
+        return self.metrics_by_dimension.get(self.base_dimension.get(group_by), frozenset())
+
+    def names_with_prefix(self, prefix):
+        """Sorted metric names starting with prefix (a binary-searched slice)."""
+        start = bisect.bisect_left(self.sorted_names, prefix)
+        end = bisect.bisect_left(self.sorted_names, prefix + "\uffff") if prefix else len(self.sorted_names)
+        return self.sorted_names[start:end]
+
+
 #######################################
 # Minimal dbtCoreClient Stub 
 # with File-based Metrics Cache (unchanged)
 #######################################
 class DBTCoreClient:
     def __init__(self):
-        self.project_dir = os.path.join(os.path.dirname(__file__), "coindbt")
+        self.project_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "coindbt")
         self.manifest_path = os.path.join(self.project_dir, "target", "manifest.json")
+        self.semantic_manifest_path = os.path.join(self.project_dir, "target", "semantic_manifest.json")
+        self.run_results_path = os.path.join(self.project_dir, "target", "run_results.json")
+        # A pool worker reads a snapshot of the warehouse (see http_wrapper.py)
+        self.warehouse_path = os.path.join(self.project_dir, os.environ.get("COINDBT_DUCKDB_PATH", "warehouse.duckdb"))
+        # The in-process engine resolves profiles.yml and its relative DuckDB
+        # path from the current directory, which is wherever the server was
+        # started from; pin both to the project so it reads the same file
+        # as warehouse_path and the `mf` fallback.
+        os.chdir(self.project_dir)
+        os.environ.setdefault("DBT_PROFILES_DIR", self.project_dir)
+        os.environ["COINDBT_DUCKDB_PATH"] = self.warehouse_path
         
         # Path to store metrics JSON file
         self.metrics_cache_file = os.path.join(self.project_dir, "target", "metrics_cache.json")
 
-        self._metrics_cache = None  # will store {"metrics": [ ... ]}
-        self._cache_lock = threading.Lock()
+        # Current catalog snapshot {"fingerprint", "signatures", "metrics"}.
+        # Rebuilds replace it in one assignment, so readers always see a
+        # complete snapshot (the old one while a rebuild is running).
+        self._metrics_cache = None
+        self._build_lock = threading.Lock()  # one rebuild at a time
+        self._cache_lock = threading.Lock()  # guards _cache_loading
         self._cache_loading = False
+        self._catalog_index = (None, CatalogIndex([]))  # (snapshot it indexes, index)
+
+        # In-process MetricFlow engine, rebuilt when semantic_manifest.json changes
+        self._engine = None
+        self._engine_manifest_mtime = None
+        self._engine_lock = threading.Lock()
+        self._sql_client = None
+
+        # `mf` subprocesses by JSON-RPC request id, so cancellations can kill them
+        self._processes = {}  # request id -> set of Popen
+        self._processes_lock = threading.Lock()
+
+        # Results of fetch_query_result, keyed by normalized query + data version
+        self.query_cache = QueryResultCache(
+            max_entries=int(os.environ.get("MCP_QUERY_CACHE_SIZE", 128)),
+            ttl_seconds=float(os.environ.get("MCP_QUERY_CACHE_TTL", 300)),
+            max_bytes=int(os.environ.get("MCP_QUERY_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+        )
+        # Add the generated SQL / `mf` command and its output to successful
+        # query responses under "debug" (large; for debugging only)
+        self.debug = os.environ.get("MCP_DEBUG", "") not in ("", "0")
 
-        # Attempt to load from file on init
+        # Attempt to load from file on init; a stale file is still served
+        # while the background refresh runs
         self._try_load_metrics_from_file()
-        if self._metrics_cache is None:
+        if self._metrics_cache is None or self._metrics_cache.get("fingerprint") != self._catalog_fingerprint():
             self._start_background_cache_loading()
 
+        # Warm the query engine so the first query does not pay for loading it
+        if MetricFlowEngine is not None:
+            threading.Thread(target=self._warm_engine, daemon=True).start()
+
+    def _catalog_sources(self):
+        """Files the metrics catalog is derived from."""
+        yaml_files = glob.glob(os.path.join(self.project_dir, "models", "**", "*.yml"), recursive=True)
+        return [self.semantic_manifest_path, self.manifest_path] + sorted(yaml_files)
+
+    def _catalog_fingerprint(self):
+        """Fingerprint (paths, mtimes and sizes) of the catalog's source files."""
+        digest = hashlib.sha256()
+        for path in self._catalog_sources():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            digest.update(f"{os.path.relpath(path, self.project_dir)}:{st.st_mtime_ns}:{st.st_size}\n".encode())
+        return digest.hexdigest()
+
     def _try_load_metrics_from_file(self):
         """Load metrics from a JSON file if it exists."""
         if os.path.exists(self.metrics_cache_file):
@@ -45,17 +421,22 @@ class DBTCoreClient:
                     data = json.load(f)
                     if "metrics" in data:
                         self._metrics_cache = data
-                        logging.info(f"Loaded metrics from file: {self.metrics_cache_file}")
+                        if data.get("fingerprint") != self._catalog_fingerprint():
+                            logging.info(f"Metrics cache file is stale: {self.metrics_cache_file}")
+                        else:
+                            logging.info(f"Loaded metrics from file: {self.metrics_cache_file}")
             except Exception as e:
                 logging.error(f"Failed to load metrics from file: {e}")
 
-    def _write_metrics_to_file(self):
-        """Write the current metrics cache to a JSON file."""
-        if self._metrics_cache is None:
-            return
+    def _write_metrics_to_file(self, snapshot):
+        """Write a metrics snapshot to the JSON cache file atomically (temp file + rename)."""
         try:
-            with open(self.metrics_cache_file, "w") as f:
-                json.dump(self._metrics_cache, f, indent=2)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.metrics_cache_file), prefix=".metrics_cache.", suffix=".tmp"
+            )
+            with os.fdopen(fd, "w") as f:
+                json.dump(snapshot, f, separators=(",", ":"))
+            os.replace(tmp_path, self.metrics_cache_file)
             logging.info(f"Wrote metrics cache to file: {self.metrics_cache_file}")
         except Exception as e:
             logging.error(f"Failed to write metrics to file: {e}")
@@ -70,7 +451,8 @@ class DBTCoreClient:
 
     def _build_metrics_cache_background(self):
         try:
-            self._build_metrics_cache()
+            with self._build_lock:
+                self._build_metrics_cache()
         except Exception as e:
             logging.error(f"Background cache build failed: {e}")
         finally:
@@ -78,9 +460,26 @@ class DBTCoreClient:
                 self._cache_loading = False
 
     def _build_metrics_cache(self):
+        """Rebuild the catalog snapshot (incrementally) and swap it in. Call with _build_lock held."""
+        fingerprint = self._catalog_fingerprint()
+        if self._metrics_cache is not None and self._metrics_cache.get("fingerprint") == fingerprint:
+            return
         logging.info("Building metrics cache...")
-        # 1) Gather all metrics from dbt ls
-        metrics_from_ls = self._get_all_metrics_info()
+        # 1) Load the semantic manifest (metrics, measures, semantic models),
+        #    re-parsing the project when it is missing or older than the YAML
+        yaml_mtimes = [os.stat(path).st_mtime for path in self._catalog_sources()[2:]]
+        if (not os.path.exists(self.semantic_manifest_path)
+                or max(yaml_mtimes, default=0) > os.stat(self.semantic_manifest_path).st_mtime):
+            logging.info("semantic_manifest.json is missing or out of date. Running `dbt parse`...")
+            subprocess.run(
+                ["dbt", "parse", "--quiet"],
+                cwd=self.project_dir,
+                capture_output=True,
+                text=True,
+                check=True
+            )
+        with open(self.semantic_manifest_path, "r") as f:
+            semantic_manifest = json.load(f)
 
         # 2) Load manifest.json (for better descriptions, etc.)
         manifest_data = {}
@@ -89,119 +488,139 @@ class DBTCoreClient:
                 manifest_data = json.load(f)
         else:
             logging.warning("No manifest.json found. Run dbt compile or dbt build first.")
-        manifest_metrics = manifest_data.get("metrics", {})
-
-        # 3) Use a thread pool to concurrently fetch dimensions for each metric
-        def process_metric(unique_id, metric_info):
-            metric_name = metric_info.get("name", "unknown_metric")
-            manifest_def = manifest_metrics.get(unique_id, {})
-            description = manifest_def.get("description") or metric_info.get("description", "")
-            dimensions = self._fetch_dimensions_for_metric(metric_name)
-            return {
-                "name": metric_name,
-                "description": description,
-                "dimensions": dimensions,
-            }
+        descriptions = {
+            metric.get("name"): metric.get("description")
+            for metric in manifest_data.get("metrics", {}).values()
+        }
 
-        metrics_list = []
-        with ThreadPoolExecutor() as executor:
-            future_to_uid = {
-                executor.submit(process_metric, uid, info): uid 
-                for uid, info in metrics_from_ls.items()
-            }
-            for future in as_completed(future_to_uid):
-                try:
-                    result = future.result()
-                    metrics_list.append(result)
-                except Exception as e:
-                    uid = future_to_uid[future]
-                    logging.error(f"Error processing metric {uid}: {e}")
-
-        # 4) Store the results in our cache and write them to file
-        self._metrics_cache = {"metrics": metrics_list}
-        logging.info("Metrics cache built successfully.")
-        self._write_metrics_to_file()
-
-    def _get_all_metrics_info(self):
-        logging.info("Fetching metrics from dbt with `dbt ls`...")
-        command = [
-            "dbt",
-            "ls",
-            "--resource-type", "metric",
-            "--output", "json",
-            "--quiet"
-        ]
-        result = subprocess.run(
-            command,
-            cwd=self.project_dir,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        lines = result.stdout.strip().split("\n")
-        metrics_map = {}
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            metric_data = json.loads(line)
-            unique_id = metric_data.get("unique_id")
-            if unique_id:
-                metrics_map[unique_id] = metric_data
-        return metrics_map
-
-    def _fetch_dimensions_for_metric(self, metric_name: str):
-        command = ["mf", "list", "dimensions", "--metrics", metric_name]
-        logging.info(f"Running: {command}")
-        result = subprocess.run(
-            command,
-            cwd=self.project_dir,
-            capture_output=True,
-            text=True,
-            check=False
-        )
-        if result.returncode != 0:
-            logging.warning(f"MetricFlow command failed for metric={metric_name}. "
-                            f"Return code={result.returncode}, stderr={result.stderr}")
-            return []
-        lines = result.stdout.strip().split("\n")
-        dimension_list = []
-        for line in lines:
-            line = line.strip()
-            if not line or line.startswith("✔"):
-                continue
-            if line.startswith("• "):
-                dim_name = line.replace("• ", "").strip()
-                dimension_list.append(dim_name)
-        return list(set(dimension_list))
+        # 3) Resolve dimensions of new or changed metrics from the semantic graph
+        metrics_list, signatures = build_metrics_catalog(semantic_manifest, descriptions, self._metrics_cache)
+
+        # 4) Write the new snapshot to file, then swap it in
+        snapshot = {
+            "fingerprint": self._catalog_fingerprint(),
+            "signatures": signatures,
+            "metrics": metrics_list,
+        }
+        self._write_metrics_to_file(snapshot)
+        self._metrics_cache = snapshot
+        logging.info(f"Metrics cache built successfully ({len(metrics_list)} metrics).")
 
     def fetchMetrics(self):
-        """Return the metrics from our in-memory or file-based cache."""
-        if self._metrics_cache is None:
-            logging.warning("Metrics cache not ready in memory.")
-            self._try_load_metrics_from_file()
+        """
+        Return the metrics of the current snapshot. If its sources changed, a
+        background refresh is started and the current snapshot is served
+        meanwhile; only when there is no snapshot at all is it built inline.
+        """
+        snapshot = self._metrics_cache
+        if snapshot is None:
+            logging.warning("Metrics cache not ready in memory. Building it now...")
+            with self._build_lock:
+                if self._metrics_cache is None:
+                    self._build_metrics_cache()
+            snapshot = self._metrics_cache
+        elif snapshot.get("fingerprint") != self._catalog_fingerprint():
+            self._start_background_cache_loading()
+
+        return {"metrics": snapshot["metrics"]}
+
+    def fetchMetricsPage(self, prefix=None, coin=None, fields="full", limit=100, cursor=None):
+        """
+        One page of the metrics catalog, sorted by name.
 
-        if self._metrics_cache is None:
-            logging.warning("Metrics cache still not ready. Returning empty result.")
-            return {"metrics": []}
+        prefix / coin   only metrics whose name starts with prefix / "<coin>_"
+        fields          "names": just names; "summary": name and description;
+                        "full": also "dimensionSet", a key into the returned
+                        "dimensionSets" (only the sets used on this page)
+        limit, cursor   page size and the "nextCursor" of the previous page
 
-        return self._metrics_cache
+        The cursor records the catalog snapshot and the arguments it was
+        issued for; it is rejected if the catalog was rebuilt since, or if
+        the arguments differ, instead of returning a shifted page.
+        """
+        if fields not in ("names", "summary", "full"):
+            raise ValueError("'fields' must be 'names', 'summary' or 'full'")
+        self.fetchMetrics()  # ensures a snapshot exists and schedules a refresh if stale
+        snapshot = self._metrics_cache
+        index = self._index()
+        limit = max(1, int(limit))
+        arguments = {"prefix": prefix or "", "coin": coin or "", "fields": fields, "limit": limit}
+
+        names = index.names_with_prefix(prefix or "")
+        if coin:
+            names = [name for name in names if name.startswith(f"{coin}_")]
+        offset = 0
+        if cursor:
+            try:
+                state = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+                offset, version = int(state["offset"]), state["version"]
+                cursor_arguments = {key: state[key] for key in arguments}
+            except Exception:
+                raise ValueError(f"Invalid cursor: {cursor}")
+            if version != snapshot.get("fingerprint"):
+                raise ValueError("The metrics catalog changed since the first page was fetched; start again without a cursor")
+            if cursor_arguments != arguments:
+                raise ValueError("The cursor belongs to a fetch_metrics call with different prefix/coin/fields/limit")
+        page = names[offset:offset + limit]
+        next_offset = offset + len(page)
+
+        if fields == "names":
+            result = {"metrics": page}
+        elif fields == "summary":
+            result = {"metrics": [
+                {"name": name, "description": index.metrics_by_name[name]["description"]} for name in page
+            ]}
+        else:
+            set_ids = [index.dimension_set_of[name] for name in page]
+            result = {
+                "metrics": [
+                    {
+                        "name": name,
+                        "description": index.metrics_by_name[name]["description"],
+                        "dimensionSet": set_id,
+                    }
+                    for name, set_id in zip(page, set_ids)
+                ],
+                "dimensionSets": {set_id: index.dimension_sets[int(set_id)] for set_id in sorted(set(set_ids), key=int)},
+            }
+        result["total"] = len(names)
+        next_cursor = None
+        if next_offset < len(names):
+            state = {**arguments, "offset": next_offset, "version": snapshot.get("fingerprint")}
+            next_cursor = base64.urlsafe_b64encode(json.dumps(state, separators=(",", ":")).encode()).decode()
+        result["nextCursor"] = next_cursor
+        return result
 
     def refreshMetrics(self):
-        """Forcibly re-build the metrics cache (synchronously)."""
+        """Re-build the metrics cache (synchronously); readers keep the old snapshot until it is swapped in."""
         logging.info("Refreshing metrics cache (synchronously)...")
-        with self._cache_lock:
+        with self._build_lock:
             self._build_metrics_cache()
-        return self._metrics_cache
+        return {"metrics": self._metrics_cache["metrics"]}
+
+    def _index(self):
+        """CatalogIndex of the current snapshot, rebuilt only after a snapshot swap."""
+        snapshot = self._metrics_cache
+        indexed_snapshot, index = self._catalog_index
+        if snapshot is not indexed_snapshot:
+            index = CatalogIndex(snapshot["metrics"] if snapshot else [])
+            self._catalog_index = (snapshot, index)
+        return index
 
     def _find_dimensions_for_metric(self, metric_name: str):
         """Return the valid dimensions for a given metric."""
-        if not self._metrics_cache:
-            return []
-        for m in self._metrics_cache["metrics"]:
-            if m["name"] == metric_name:
-                return m["dimensions"]
-        return []
+        return sorted(self._index().dimensions_for_metric(metric_name))
+
+    def findMetricsForDimensions(self, dimensions):
+        """Metrics that support every one of the given dimensions (time grain suffixes allowed)."""
+        index = self._index()
+        unknown = [dim for dim in dimensions if dim not in index.base_dimension]
+        metric_sets = [index.metrics_for_dimension(dim) for dim in dimensions]
+        return {
+            "dimensions": {dim: index.base_dimension.get(dim) for dim in dimensions},
+            "unknownDimensions": unknown,
+            "metrics": sorted(frozenset.intersection(*metric_sets)) if metric_sets else [],
+        }
 
     #######################################
     # createQuery returns the *structure*
@@ -235,21 +654,14 @@ class DBTCoreClient:
                 "query": query_params
             }
 
-        # Validate groupBys for each metric
-        invalid_dims = []
-        for metric_name in metrics_list:
-            valid_dims = self._find_dimensions_for_metric(metric_name)
-            for requested_dim in group_bys:
-                if requested_dim in valid_dims:
-                    continue
-                # If there's a time-suffix, try to remove it
-                parts = requested_dim.split("__")
-                if len(parts) > 1:
-                    base_dim = "__".join(parts[:-1])
-                else:
-                    base_dim = requested_dim
-                if base_dim not in valid_dims:
-                    invalid_dims.append((metric_name, requested_dim))
+        # Validate groupBys for each metric (time grain suffixes like __month allowed)
+        index = self._index()
+        invalid_dims = [
+            (metric_name, requested_dim)
+            for metric_name in metrics_list
+            for requested_dim in group_bys
+            if not index.supports(metric_name, requested_dim)
+        ]
 
         if invalid_dims:
             lines = []
@@ -274,88 +686,375 @@ class DBTCoreClient:
         }
 
     #######################################
-    # Instead of referencing a stored queryId,
-    # we run the query from the provided dict
+    # In-process MetricFlow engine
     #######################################
-
-    import re
-
-    def parse_metricflow_table(self,raw_output: str) -> list[dict]:
+    def _get_engine(self):
         """
-        Parse space-aligned MetricFlow table output like:
-
-            metric_time__month      max_price_volatility_all_coins    min_price_volatility_all_coins ...
-            --------------------    ------------------------------     -------------------------------
-            2024-03-01T00:00:00     0.119452                          0.0220735
-            ...
+        Return a warm MetricFlowEngine, or None if MetricFlow is not importable
+        or the project has not been parsed yet. The semantic manifest is
+        reloaded when target/semantic_manifest.json changes; the dbt adapter
+        (and its DuckDB connection) is created once and reused.
+        """
+        if MetricFlowEngine is None:
+            return None
+        try:
+            manifest_mtime = os.stat(self.semantic_manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            logging.warning("No semantic_manifest.json found. Run dbt parse first.")
+            return None
+
+        with self._engine_lock:
+            if self._engine is not None and manifest_mtime == self._engine_manifest_mtime:
+                return self._engine
+            logging.info("Loading semantic manifest into the in-process MetricFlow engine...")
+            if self._sql_client is None:
+                project = dbtProjectMetadata.load_from_project_path(Path(self.project_dir))
+                artifacts = dbtArtifacts.load_from_project_metadata(project)
+                self._sql_client = AdapterBackedSqlClient(artifacts.adapter)
+                semantic_manifest = artifacts.semantic_manifest
+            else:
+                semantic_manifest = dbtArtifacts.build_semantic_manifest_from_dbt_project_root(Path(self.project_dir))
+            self._engine = MetricFlowEngine(
+                semantic_manifest_lookup=SemanticManifestLookup(semantic_manifest),
+                sql_client=self._sql_client,
+            )
+            self._engine_manifest_mtime = manifest_mtime
+            return self._engine
 
-        Returns a list of dict rows, e.g.:
-        [
-        {
-            "metric_time__month": "2024-03-01T00:00:00",
-            "max_price_volatility_all_coins": "0.119452",
-            "min_price_volatility_all_coins": "0.0220735",
-            ...
-        },
-        ...
-        ]
+    def _warm_engine(self):
+        try:
+            self._get_engine()
+        except Exception as e:
+            logging.error(f"Failed to warm the MetricFlow engine: {e}")
+
+    @staticmethod
+    def _json_value(value):
+        """Make a warehouse value JSON-serializable."""
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            return value.isoformat()
+        if isinstance(value, decimal.Decimal):
+            return float(value)
+        if hasattr(value, "item"):  # numpy / pandas scalars
+            value = value.item()
+        if isinstance(value, float) and math.isnan(value):
+            return None
+        return value
+
+    @staticmethod
+    def _column_type(values):
+        """JSON-level type of a result column: timestamp, number, boolean, string or null."""
+        present = [v for v in values if v is not None]
+        if not present:
+            return "null"
+        if all(isinstance(v, (datetime.date, datetime.datetime)) for v in present):
+            return "timestamp"
+        if all(isinstance(v, bool) for v in present):
+            return "boolean"
+        if all(isinstance(v, numbers.Number) and not isinstance(v, bool) for v in present):
+            return "number"
+        return "string"
+
+    def _table_from_engine(self, table):
+        """
+        Column-oriented result table from a MetricFlow result (a
+        MetricFlowDataTable, or a pandas DataFrame on older releases):
+        {"columns": [...], "types": [...], "data": [[column values], ...]}
         """
-        lines = raw_output.strip().split("\n")
+        if hasattr(table, "column_names"):
+            columns = list(table.column_names)
+            data = [list(col) for col in zip(*table.rows)] or [[] for _ in columns]
+        else:
+            columns = list(table.columns)
+            data = [table[col].tolist() for col in columns]
+        return {
+            "columns": columns,
+            "types": [self._column_type(col) for col in data],
+            "data": [[self._json_value(v) for v in col] for col in data],
+        }
 
-        # 1) Strip out spinner/log lines, e.g. containing “✔” or “Success” or “Initiating query”:
-        #    (Adjust as needed)
-        data_lines = [
-            line for line in lines
-            if line and not any(sub in line for sub in ["⠋", "✔", "🖨", "Initiating query", "Success", "written query"])
-        ]
+    ISO_TIMESTAMP = re.compile(r"^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?$")
 
-        # 2) If there’s nothing left, return empty
-        if not data_lines:
-            return []
-
-        # The first non-dashed line should be the header (e.g. "metric_time__month      max_price...")
-        header_line = data_lines[0]
-
-        # The second line is usually the dashed "----" line. We can skip it:
-        #   --------------------  ------------------------------  ...
-        #   But let's be robust in case sometimes there's no dashed line.
-        #   We'll look for the first "----" line in data_lines.
-        dashed_line_idx = None
-        for idx, line in enumerate(data_lines):
-            if re.match(r"^\s*-+\s*-+\s*", line):
-                dashed_line_idx = idx
-                break
-
-        # If we found a dashed line, the data lines start after that line
-        data_start_idx = dashed_line_idx + 1 if dashed_line_idx is not None else 1
-
-        # 3) Split the header line on 2+ spaces to get column names
-        #    e.g. "metric_time__month      max_price_volatility_all_coins" -> columns
-        header_cols = re.split(r"\s{2,}", header_line.strip())
-
-        # 4) For each subsequent line, split on 2+ spaces and map to the corresponding column
-        table_rows = []
-        for line in data_lines[data_start_idx:]:
-            # If it's another dashed line or blank, skip
-            if re.match(r"^\s*-+\s*$", line):
-                continue
+    def _table_from_csv(self, csv_path):
+        """Column-oriented result table (see _table_from_engine) from an `mf query --csv` file."""
+        with open(csv_path, newline="") as f:
+            reader = csv.reader(f)
+            columns = next(reader, [])
+            data = [list(col) for col in zip(*reader)] or [[] for _ in columns]
 
-            cols = re.split(r"\s{2,}", line.strip())
+        types = []
+        for i, col in enumerate(data):
+            values = [v if v != "" else None for v in col]
+            present = [v for v in values if v is not None]
+            try:
+                values = [None if v is None else int(v) for v in values]
+                col_type = "number"
+            except ValueError:
+                try:
+                    values = [None if v is None else float(v) for v in values]
+                    values = [None if v is not None and math.isnan(v) else v for v in values]
+                    col_type = "number"
+                except ValueError:
+                    col_type = "timestamp" if all(self.ISO_TIMESTAMP.match(v) for v in present) else "string"
+            data[i] = values
+            types.append(col_type if present else "null")
+        return {"columns": columns, "types": types, "data": data}
+
+    def _run_query_in_process(self, engine, metrics_list, group_bys, limit_value):
+        request = MetricFlowQueryRequest.create_with_random_request_id(
+            metric_names=metrics_list,
+            group_by_names=group_bys or None,
+            limit=limit_value,
+        )
+        logging.info(f"Running MetricFlow query in-process: metrics={metrics_list}, group_by={group_bys}")
+        result = engine.query(request)
+        output = {
+            "status": "SUCCESSFUL",
+            "results": self._table_from_engine(result.result_df),
+        }
+        if self.debug:
+            output["debug"] = {"sql": result.sql}
+        return output
+
+    def cancel(self, request_id):
+        """Kill the `mf` subprocesses running for a request, if any."""
+        with self._processes_lock:
+            processes = self._processes.pop(request_id, set())
+        killed = False
+        for process in processes:
+            if process.poll() is None:
+                logging.info(f"Killing MetricFlow command for cancelled request {request_id}")
+                process.kill()
+                killed = True
+        return killed
+
+    def _data_version(self):
+        """
+        Stamp that changes whenever query results may change: the DuckDB
+        warehouse (and its WAL), the last dbt run and the semantic manifest.
+        """
+        version = []
+        for path in (self.warehouse_path, self.warehouse_path + ".wal",
+                     self.run_results_path, self.semantic_manifest_path):
+            try:
+                st = os.stat(path)
+                version.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+    @staticmethod
+    def _query_cache_key(query_dict):
+        """Canonical form of a query: metric and group-by order do not change the result."""
+        limit_value = query_dict.get("limit")
+        if isinstance(limit_value, float):
+            limit_value = int(limit_value)
+        return json.dumps({
+            "metrics": sorted(set(query_dict.get("metrics", []))),
+            "groupBy": sorted(set(query_dict.get("groupBy", []))),
+            "limit": limit_value,
+            "orderBy": list(query_dict.get("orderBy", [])),
+        }, sort_keys=True)
+
+    def _cached_query(self, query_dict):
+        """Run a query through the result cache; returns (result with raw table, cached)."""
+        key = (self._query_cache_key(query_dict), self._data_version())
+        result = self.query_cache.get(key)
+        cached = result is not None
+        if not cached:
+            result = self._run_query(query_dict)
+            if result["status"] == "SUCCESSFUL":
+                self.query_cache.put(key, result)
+        return result, cached
+
+    def _data_stamp(self):
+        """Short digest of _data_version(), carried in page cursors."""
+        return hashlib.sha1(repr(self._data_version()).encode()).hexdigest()[:16]
+
+    def run_query_from_dict(self, query_dict, results_format="columns", page_size=None, offset=0, total_rows=None):
+        """
+        Run a query (through the result cache). With page_size only rows
+        [offset, offset + page_size) are fetched and encoded (see
+        _run_query_page), along with "offset", "totalRows" and a "nextCursor"
+        for fetchNextPage (None on the last page).
+        """
+        if not page_size:
+            result, cached = self._cached_query(query_dict)
+            if result["status"] == "SUCCESSFUL":
+                result = {**result, "results": encode_results(result["results"], results_format), "cached": cached}
+            return result
+
+        stamp = self._data_stamp()
+        key = (self._query_cache_key(query_dict), offset, page_size, self._data_version())
+        page = self.query_cache.get(key)
+        cached = page is not None
+        if not cached:
+            page = self._run_query_page(query_dict, offset, page_size, count_rows=total_rows is None)
+            if page["status"] == "SUCCESSFUL":
+                self.query_cache.put(key, page)
+        if page["status"] != "SUCCESSFUL":
+            return page
+
+        total_rows = page.get("totalRows", total_rows)
+        end = offset + page_size
+        next_cursor = None
+        if end < total_rows:
+            state = {"query": query_dict, "format": results_format, "pageSize": page_size,
+                     "offset": end, "totalRows": total_rows, "version": stamp}
+            next_cursor = base64.urlsafe_b64encode(json.dumps(state, separators=(",", ":")).encode()).decode()
+        return {
+            **page,
+            "results": encode_results(page["results"], results_format),
+            "cached": cached,
+            "offset": offset,
+            "totalRows": total_rows,
+            "nextCursor": next_cursor,
+        }
 
-            # If the line doesn't have the same number of columns as the header,
-            # skip or handle gracefully
-            if len(cols) != len(header_cols):
-                continue
+    @staticmethod
+    def _explain_sql(explain_result):
+        """SQL text of a MetricFlow explain result (SqlStatement.sql, or SqlQuery.sql_query on older releases)."""
+        statement = explain_result.rendered_sql_without_descriptions
+        sql = getattr(statement, "sql", None) or statement.sql_query
+        return sql.strip().rstrip(";")
 
-            row_dict = {}
-            for col_name, value in zip(header_cols, cols):
-                row_dict[col_name] = value
+    def _run_query_page(self, query_dict, offset, page_size, count_rows):
+        """
+        Rows [offset, offset + page_size) of a query, plus "totalRows" when
+        count_rows is set. On the in-process engine the page is fetched with
+        LIMIT/OFFSET over the compiled SQL, ordered by every column so pages
+        are stable, so only one page is held in memory and any worker can
+        serve any page. The `mf` CLI fallback has no such hook: it runs the
+        whole query (through the result cache) and slices it.
+        """
+        metrics_list = query_dict.get("metrics", [])
+        if not metrics_list:
+            return {"status": "ERROR", "results": [], "error": "No metrics provided"}
+        limit_value = query_dict.get("limit")
+        if isinstance(limit_value, float):
+            limit_value = int(limit_value)
 
-            table_rows.append(row_dict)
+        try:
+            engine = self._get_engine()
+        except Exception:
+            logging.exception("Failed to load the in-process MetricFlow engine; falling back to `mf query`")
+            engine = None
+        if engine is None:
+            result, _ = self._cached_query(query_dict)
+            if result["status"] != "SUCCESSFUL":
+                return result
+            table = result["results"]
+            page = {**result, "results": slice_results(table, offset, offset + page_size)}
+            if count_rows:
+                page["totalRows"] = len(table["data"][0]) if table["data"] else 0
+            return page
 
-        return table_rows
-    
-    def run_query_from_dict(self, query_dict):
+        try:
+            request = MetricFlowQueryRequest.create_with_random_request_id(
+                metric_names=metrics_list,
+                group_by_names=query_dict.get("groupBy") or None,
+                limit=limit_value,
+            )
+            sql = self._explain_sql(engine.explain(request))
+            logging.info(f"Fetching rows {offset}-{offset + page_size} of query: metrics={metrics_list}")
+            rows = self._sql_client.query(
+                f"SELECT * FROM ({sql}) AS query_result ORDER BY ALL LIMIT {int(page_size)} OFFSET {int(offset)}"
+            )
+            page = {"status": "SUCCESSFUL", "results": self._table_from_engine(rows)}
+            if count_rows:
+                count = self._sql_client.query(f"SELECT COUNT(*) AS row_count FROM ({sql}) AS query_result")
+                page["totalRows"] = int(self._table_from_engine(count)["data"][0][0])
+            if self.debug:
+                page["debug"] = {"sql": sql}
+            return page
+        except Exception as e:
+            logging.exception("MetricFlow page query failed")
+            return {"status": "ERROR", "results": [], "error": str(e)}
+
+    def fetchNextPage(self, cursor):
+        """The page a run_query_from_dict "nextCursor" points to."""
+        try:
+            state = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            query_dict, results_format = state["query"], state["format"]
+            page_size, offset, version = int(state["pageSize"]), int(state["offset"]), state["version"]
+            total_rows = int(state["totalRows"])
+        except Exception:
+            raise ValueError(f"Invalid cursor: {cursor}")
+        if version != self._data_stamp():
+            raise ValueError("The data changed since the first page was fetched; run fetch_query_result again")
+        return self.run_query_from_dict(query_dict, results_format, page_size, offset, total_rows)
+
+    @staticmethod
+    def _batch_group_key(query_dict, index):
+        """
+        Queries with the same key can be answered by one query over the union
+        of their metrics: they share group-bys, ordering and filters, and
+        their metrics come from the same semantic models, so the merged query
+        has exactly the rows each of them would get on its own. None for
+        queries that must run on their own: with a limit (it would pick rows
+        of the merged query, not of this one) or with a metric the catalog
+        does not know the semantic models of.
+        """
+        if query_dict.get("limit") is not None:
+            return None
+        models = set()
+        for metric_name in query_dict["metrics"]:
+            if not index.models_by_metric.get(metric_name):
+                return None
+            models |= index.models_by_metric[metric_name]
+        return json.dumps({
+            "groupBy": sorted(set(query_dict.get("groupBy", []))),
+            "orderBy": list(query_dict.get("orderBy", [])),
+            "where": query_dict.get("where"),
+            "semanticModels": sorted(models),
+        }, sort_keys=True)
+
+    def run_query_batch(self, queries, results_format="columns", max_workers=4):
+        """
+        Run several queries with as few engine queries as possible: queries
+        without a limit, with the same group-bys, ordering and filters and
+        over the same semantic models are merged into one query over the
+        union of their metrics, independent
+        groups run in parallel, and each request gets back only its own
+        metrics (see split_results). Returns one result per input query, in
+        input order.
+        """
+        results = [None] * len(queries)
+        groups = OrderedDict()
+        index = self._index()
+        for index, query_dict in enumerate(queries):
+            if not query_dict.get("metrics"):
+                results[index] = {"status": "ERROR", "results": [], "error": "No metrics provided"}
+                continue
+            key = self._batch_group_key(query_dict, index)
+            groups.setdefault(key if key is not None else ("unmerged", index), []).append(index)
+
+        def run_group(indices):
+            metrics_union = []
+            for index in indices:
+                for metric_name in queries[index]["metrics"]:
+                    if metric_name not in metrics_union:
+                        metrics_union.append(metric_name)
+            merged_query = {**queries[indices[0]], "metrics": metrics_union}
+            result, cached = self._cached_query(merged_query)
+            if result["status"] != "SUCCESSFUL" and len(indices) > 1:
+                # One bad metric must not fail the other requests: run them separately
+                logging.warning(f"Batched query over {metrics_union} failed; running its {len(indices)} queries separately")
+                return [(index, queries[index]["metrics"]) + self._cached_query(queries[index]) for index in indices]
+            return [(index, metrics_union, result, cached) for index in indices]
+
+        context = contextvars.copy_context()
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(groups)))) as executor:
+            futures = [executor.submit(context.copy().run, run_group, indices) for indices in groups.values()]
+            for group_number, future in enumerate(futures):
+                for index, batch_metrics, result, cached in future.result():
+                    if result["status"] == "SUCCESSFUL":
+                        table = split_results(result["results"], queries[index]["metrics"], batch_metrics)
+                        result = {**result, "results": encode_results(table, results_format),
+                                  "cached": cached, "batchGroup": group_number}
+                    results[index] = result
+        return results
+
+    def _run_query(self, query_dict):
         """
         Takes a dict like:
           {
@@ -364,7 +1063,12 @@ class DBTCoreClient:
              "limit": 123,
              "orderBy": [...]
           }
-        Then runs 'mf query' accordingly and returns rows or error.
+        Then runs it on the in-process MetricFlow engine (falling back to
+        'mf query --csv') and returns the results or error.
+
+        results_format "columns" returns the typed column-oriented table
+        {"columns": [...], "types": [...], "data": [[...], ...], "rowCount": n};
+        "rows" returns [[{column: value, ...}, ...]] as earlier versions did.
         """
         metrics_list = query_dict.get("metrics", [])
         group_bys = query_dict.get("groupBy", [])
@@ -380,50 +1084,73 @@ class DBTCoreClient:
                 "error": "No metrics provided"
             }
 
+        if isinstance(limit_value, float):
+            limit_value = int(limit_value)  # e.g. 10.0 -> 10
+
+        try:
+            engine = self._get_engine()
+        except Exception:
+            logging.exception("Failed to load the in-process MetricFlow engine; falling back to `mf query`")
+            engine = None
+        if engine is not None:
+            try:
+                return self._run_query_in_process(engine, metrics_list, group_bys, limit_value)
+            except Exception as e:
+                logging.exception("MetricFlow query failed")
+                return {
+                    "status": "ERROR",
+                    "results": [],
+                    "error": str(e)
+                }
+
         command = ["mf", "query"]
         command.extend(["--metrics", ",".join(metrics_list)])
 
         if group_bys:
             command.extend(["--group-by", ",".join(group_bys)])
         if limit_value is not None:
-            if isinstance(limit_value, float):
-                limit_value = int(limit_value)  # e.g. 10.0 -> 10
-            if limit_value is not None:
-                command.extend(["--limit", str(limit_value)])
+            command.extend(["--limit", str(limit_value)])
 
         # Possibly handle filters or orderBy if desired
+        csv_file = tempfile.NamedTemporaryFile(suffix=".csv", delete=False)
+        csv_file.close()
+        command.extend(["--csv", csv_file.name])
         logging.info(f"Submitting MetricFlow command: {command}")
 
         try:
-            result = subprocess.run(
+            # Registered under the JSON-RPC request id so a cancellation can kill it
+            request_id = current_request_id.get()
+            process = subprocess.Popen(
                 command,
                 cwd=self.project_dir,
-                capture_output=True,
-                text=True,
-                check=False
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
             )
-
-            if result.returncode != 0:
+            with self._processes_lock:
+                self._processes.setdefault(request_id, set()).add(process)
+            try:
+                stdout, stderr = process.communicate()
+            finally:
+                with self._processes_lock:
+                    self._processes.get(request_id, set()).discard(process)
+                    if not self._processes.get(request_id, True):
+                        del self._processes[request_id]
+
+            if process.returncode != 0:
                 return {
                     "status": "ERROR",
                     "results": [],
-                    "error": f"Command failed with code {result.returncode}: {result.stderr}"
+                    "error": f"Command failed with code {process.returncode}: {stderr}"
                 }
-            
-            parsed_rows = self.parse_metricflow_table(result.stdout)
-
 
-         
-            return {
+            output = {
                 "status": "SUCCESSFUL",
-                "results": [parsed_rows],
-                "error": {
-                    "stdout": result.stdout,
-                    "sterror": result.stderr,
-                    "command": command
-                }
+                "results": self._table_from_csv(csv_file.name),
             }
-
+            if self.debug:
+                output["debug"] = {"command": command, "stdout": stdout, "stderr": stderr}
+            return output
 
         except Exception as e:
             logging.exception("Unexpected error running query")
@@ -432,6 +1159,36 @@ class DBTCoreClient:
                 "results": [],
                 "error": str(e)
             }
+        finally:
+            os.unlink(csv_file.name)
+
+
+def split_results(table, metrics, batch_metrics):
+    """
+    The part of a batched result table that answers one query: every column
+    except the other queries' metrics. Batched queries are over the same
+    semantic models (see _batch_group_key), so the rows are already the ones
+    a standalone query would return.
+    """
+    other_metrics = set(batch_metrics) - set(metrics)
+    keep = [i for i, column in enumerate(table["columns"]) if column not in other_metrics]
+    return {
+        "columns": [table["columns"][i] for i in keep],
+        "types": [table["types"][i] for i in keep],
+        "data": [table["data"][i] for i in keep],
+    }
+
+
+def slice_results(table, start, end):
+    """Rows [start, end) of a column-oriented result table."""
+    return {**table, "data": [col[start:end] for col in table["data"]]}
+
+
+def encode_results(table, results_format):
+    """Encode a column-oriented result table for the MCP response ("columns" or "rows")."""
+    if results_format == "rows":
+        return [[dict(zip(table["columns"], row)) for row in zip(*table["data"])]]
+    return {**table, "rowCount": len(table["data"][0]) if table["data"] else 0}
 
 #######################################
 # Instance
@@ -489,10 +1246,32 @@ def handle_list_tools_request():
             },
             {
                 "name": "fetch_metrics",
-                "description": "Fetch a list of metrics from dbt Core’s semantic layer.",
+                "description": "Fetch a page of metrics from dbt Core’s semantic layer. Metrics sharing the same dimensions point to one entry of 'dimensionSets'. Pass 'nextCursor' back as 'cursor' for the next page.",
                 "inputSchema": {
                     "type": "object",
-                    "properties": {},
+                    "properties": {
+                        "prefix": {
+                            "type": "string",
+                            "description": "Only metrics whose name starts with this prefix"
+                        },
+                        "coin": {
+                            "type": "string",
+                            "description": "Only metrics of this coin, e.g. 'bitcoin'"
+                        },
+                        "fields": {
+                            "type": "string",
+                            "enum": ["names", "summary", "full"],
+                            "description": "'names': names only; 'summary': names and descriptions; 'full' (default): also dimensions"
+                        },
+                        "limit": {
+                            "type": "number",
+                            "description": "Page size (default 100)"
+                        },
+                        "cursor": {
+                            "type": "string",
+                            "description": "nextCursor of the previous page, with the same prefix/coin/fields/limit"
+                        }
+                    },
                     "required": []
                 }
             },
@@ -552,10 +1331,97 @@ def handle_list_tools_request():
                                 }
                             },
                             "required": ["metrics"]
+                        },
+                        "format": {
+                            "type": "string",
+                            "enum": ["columns", "rows"],
+                            "description": "'columns' (default): column names and types once plus one value array per column. 'rows': one object per row."
+                        },
+                        "pageSize": {
+                            "type": "number",
+                            "description": "Return at most this many rows, with 'totalRows' and a 'nextCursor' for fetch_next_page. Omit for the whole result."
                         }
                     },
                     "required": ["query"]
                 }
+            },
+            {
+                "name": "fetch_next_page",
+                "description": "Fetch the next page of a paged fetch_query_result, given its 'nextCursor'.",
+                "inputSchema": {
+                    "type": "object",
+                    "properties": {
+                        "cursor": {
+                            "type": "string",
+                            "description": "'nextCursor' from the previous page"
+                        }
+                    },
+                    "required": ["cursor"]
+                }
+            },
+            {
+                "name": "fetch_query_results_batch",
+                "description": "Run several query objects at once. Queries without a limit, with the same groupBy/orderBy and over the same semantic models share one warehouse query; results come back in request order.",
+                "inputSchema": {
+                    "type": "object",
+                    "properties": {
+                        "queries": {
+                            "type": "array",
+                            "description": "Query dicts as returned by create_query",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "metrics": {
+                                        "type": "array",
+                                        "items": {"type": "string"}
+                                    },
+                                    "groupBy": {
+                                        "type": "array",
+                                        "items": {"type": "string"}
+                                    },
+                                    "limit": {
+                                        "type": "number"
+                                    },
+                                    "orderBy": {
+                                        "type": "array",
+                                        "items": {"type": "string"}
+                                    }
+                                },
+                                "required": ["metrics"]
+                            }
+                        },
+                        "format": {
+                            "type": "string",
+                            "enum": ["columns", "rows"],
+                            "description": "Result format of every query, as in fetch_query_result."
+                        }
+                    },
+                    "required": ["queries"]
+                }
+            },
+            {
+                "name": "find_metrics_for_dimensions",
+                "description": "List the metrics that can be grouped by all of the given dimensions (time grain suffixes like metric_time__month allowed).",
+                "inputSchema": {
+                    "type": "object",
+                    "properties": {
+                        "dimensions": {
+                            "type": "array",
+                            "description": "Dimension names, e.g. ['metric_time__month']",
+                            "items": {"type": "string"}
+                        }
+                    },
+                    "required": ["dimensions"]
+                }
+            },
+            {
+                "name": "get_query_cache_stats",
+                "description": "Hit/miss counters and size of the fetch_query_result cache.",
+                "inputSchema": {
+                    "type": "object",
+                    "properties": {},
+                    "required": []
+                }
             }
         ]
     }
@@ -567,11 +1433,19 @@ def handle_call_tool_request(params):
     if tool_name == "get_documentation":
         return handle_get_documentation()
     elif tool_name == "fetch_metrics":
-        return handle_fetch_metrics()
+        return handle_fetch_metrics(args)
     elif tool_name == "create_query":
         return handle_create_query(args)
     elif tool_name == "fetch_query_result":
         return handle_fetch_query_result(args)
+    elif tool_name == "fetch_next_page":
+        return handle_fetch_next_page(args)
+    elif tool_name == "fetch_query_results_batch":
+        return handle_fetch_query_results_batch(args)
+    elif tool_name == "find_metrics_for_dimensions":
+        return handle_find_metrics_for_dimensions(args)
+    elif tool_name == "get_query_cache_stats":
+        return handle_get_query_cache_stats()
     else:
         raise ValueError(f"Unknown tool: {tool_name}")
 
@@ -580,19 +1454,50 @@ def handle_get_documentation():
         "# Guide: Using the dbt Semantic Layer MCP Server (Python)\n\n"
         "## Tools\n"
         "1. **get_documentation** – This guide.\n"
-        "2. **fetch_metrics** – Get a list of known metrics.\n"
+        "2. **fetch_metrics** – Get a page of known metrics (filter with `prefix`/`coin`, "
+        "choose `fields`, follow `nextCursor`).\n"
         "3. **create_query** – Build a query object (no ID).\n"
-        "4. **fetch_query_result** – Provide the query object and run it.\n\n"
+        "4. **fetch_query_result** – Provide the query object and run it. Identical queries are "
+        "served from a cache until new data lands (`cached: true`). Pass `pageSize` for large "
+        "results.\n"
+        "5. **fetch_next_page** – Next page of a paged result, from its `nextCursor`.\n"
+        "6. **fetch_query_results_batch** – Run a list of query objects in one call. Queries "
+        "without a limit, with the same groupBy/orderBy and over the same semantic models are "
+        "answered by a single warehouse query.\n"
+        "7. **find_metrics_for_dimensions** – Which metrics support the given dimensions.\n"
+        "8. **get_query_cache_stats** – Cache hit/miss counters.\n\n"
         "### Example:\n"
         "1. fetch_metrics -> see what's available\n"
         "2. create_query -> get {status, query}\n"
-        "3. fetch_query_result -> pass that same `query` to get results\n"
+        "3. fetch_query_result -> pass that same `query` to get results\n\n"
+        "### Result format\n"
+        "By default `results` is column-oriented: `columns` (names), `types` "
+        "(timestamp/number/boolean/string/null), `data` (one value array per column) "
+        "and `rowCount`. Pass `\"format\": \"rows\"` for one object per row.\n\n"
+        "### Paging\n"
+        "With `pageSize`, fetch_query_result returns the first rows plus `totalRows` and "
+        "`nextCursor`; pass `nextCursor` to fetch_next_page until it is null.\n"
     )
     return [{"type": "text", "text": guide_text}]
 
-def handle_fetch_metrics():
-    result = dbt_client.fetchMetrics()
-    return [{"type": "text", "text": json.dumps(result, indent=2)}]
+def handle_fetch_metrics(args):
+    result = dbt_client.fetchMetricsPage(
+        prefix=args.get("prefix"),
+        coin=args.get("coin"),
+        fields=args.get("fields", "full"),
+        limit=args.get("limit", 100),
+        cursor=args.get("cursor"),
+    )
+    return [{"type": "text", "text": json.dumps(result, separators=(",", ":"))}]
+
+def handle_find_metrics_for_dimensions(args):
+    dimensions = args.get("dimensions")
+    if isinstance(dimensions, str):
+        dimensions = [dimensions]
+    if not dimensions:
+        raise ValueError("'dimensions' is required, e.g. ['metric_time__month']")
+    result = dbt_client.findMetricsForDimensions(dimensions)
+    return [{"type": "text", "text": json.dumps(result, separators=(",", ":"))}]
 
 def handle_create_query(args):
     # Return { "status": "...", "query": {...} }
@@ -608,23 +1513,115 @@ def handle_fetch_query_result(args):
            "groupBy": [...],
            "limit": 123,
            "orderBy": [...]
-        }
+        },
+        "format": "columns",  # optional, or "rows"
+        "pageSize": 1000      # optional: page the rows (see fetch_next_page)
       }
     """
     query_obj = args.get("query")
     if not query_obj:
         raise ValueError("'query' is required, with shape { metrics: [...], groupBy: [...], ... }")
+    results_format = args.get("format", "columns")
+    if results_format not in ("columns", "rows"):
+        raise ValueError("'format' must be 'columns' or 'rows'")
+
+    page_size = args.get("pageSize")
+    if page_size is not None:
+        page_size = int(page_size)
+        if page_size < 1:
+            raise ValueError("'pageSize' must be a positive number of rows")
+
+    results = dbt_client.run_query_from_dict(query_obj, results_format, page_size)
+    return [{"type": "text", "text": json.dumps(results, separators=(",", ":"))}]
+
+def handle_fetch_next_page(args):
+    cursor = args.get("cursor")
+    if not cursor:
+        raise ValueError("'cursor' is required: the 'nextCursor' of a paged fetch_query_result")
+    results = dbt_client.fetchNextPage(cursor)
+    return [{"type": "text", "text": json.dumps(results, separators=(",", ":"))}]
+
+def handle_fetch_query_results_batch(args):
+    """
+    Expects {"queries": [{metrics, groupBy, limit, orderBy}, ...], "format": "columns"}
+    and returns {"results": [<fetch_query_result response>, ...]} in request order.
+    """
+    queries = args.get("queries")
+    if not queries or not isinstance(queries, list):
+        raise ValueError("'queries' is required: a list of { metrics: [...], groupBy: [...], ... }")
+    results_format = args.get("format", "columns")
+    if results_format not in ("columns", "rows"):
+        raise ValueError("'format' must be 'columns' or 'rows'")
+
+    results = dbt_client.run_query_batch(
+        queries, results_format, max_workers=int(os.environ.get("MCP_MAX_WORKERS", 4))
+    )
+    return [{"type": "text", "text": json.dumps({"results": results}, separators=(",", ":"))}]
 
-    results = dbt_client.run_query_from_dict(query_obj)
-    return [{"type": "text", "text": json.dumps(results, indent=2)}]
+def handle_get_query_cache_stats():
+    return [{"type": "text", "text": json.dumps(dbt_client.query_cache.stats())}]
 
 
 #######################################
 # Main loop
 #######################################
-def main():
-    logging.info("dbt Semantic Layer MCP Python server starting up. Listening on stdin for JSON-RPC requests...")
-    for line in sys.stdin:
+stdout_lock = threading.Lock()
+
+def write_message(message):
+    response_str = json.dumps(message)
+    logging.debug(f"Sending response: {response_str}")
+    with stdout_lock:
+        sys.stdout.write(response_str + "\n")
+        sys.stdout.flush()
+
+def handle_request(method, params, request_id):
+    """Handle one JSON-RPC request and return the response object."""
+    try:
+        if method == "initialize":
+            response_obj = handle_initialize_request(params)
+            output = build_success_response(request_id, response_obj)
+        elif method == "tools/list":
+            response_obj = handle_list_tools_request()
+            output = build_success_response(request_id, response_obj)
+        elif method == "tools/call":
+            response_obj = handle_call_tool_request(params)
+            output = build_success_response(request_id, {"content": response_obj})
+        else:
+            logging.warning(f"Unknown method: {method}")
+            output = build_error_response(request_id, -32601, f"Unknown method: {method}")
+    except Exception as e:
+        logging.exception(f"Exception handling request {method}")
+        output = build_error_response(request_id, -32603, f"Internal error: {str(e)}")
+    return output
+
+async def serve(max_workers):
+    """
+    Read JSON-RPC messages from stdin and dispatch them without head-of-line
+    blocking: tools/call requests run on a pool of max_workers threads and
+    their responses are written as they complete (out of order, matched by
+    id); other requests are answered inline. notifications/cancelled drops
+    the in-flight request's response and kills its `mf` subprocess, if any.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mcp-worker")
+    in_flight = {}  # request id -> asyncio.Task
+
+    async def run_tool_call(request_id, method, params):
+        context = contextvars.copy_context()
+        context.run(current_request_id.set, request_id)
+        try:
+            output = await loop.run_in_executor(executor, context.run, handle_request, method, params, request_id)
+        except asyncio.CancelledError:
+            logging.info(f"Request {request_id} cancelled; not sending a response.")
+            return
+        finally:
+            in_flight.pop(request_id, None)
+        write_message(output)
+
+    while True:
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line:
+            break
         raw_line = line.strip()
         if not raw_line:
             continue
@@ -644,32 +1641,34 @@ def main():
             if method == "notifications/initialized":
                 logging.info("Received notifications/initialized. Doing nothing.")
             elif method == "notifications/cancelled":
-                logging.info("Received notifications/cancelled. Doing nothing.")
+                cancelled_id = (params or {}).get("requestId")
+                task = in_flight.get(cancelled_id)
+                logging.info(f"Received notifications/cancelled for request {cancelled_id} (in flight: {task is not None}).")
+                if task is not None:
+                    task.cancel()
+                    dbt_client.cancel(cancelled_id)
             else:
                 logging.info(f"Unknown notification method '{method}', ignoring.")
             continue
 
-        try:
-            if method == "initialize":
-                response_obj = handle_initialize_request(params)
-                output = build_success_response(request_id, response_obj)
-            elif method == "tools/list":
-                response_obj = handle_list_tools_request()
-                output = build_success_response(request_id, response_obj)
-            elif method == "tools/call":
-                response_obj = handle_call_tool_request(params)
-                output = build_success_response(request_id, {"content": response_obj})
-            else:
-                logging.warning(f"Unknown method: {method}")
-                output = build_error_response(request_id, -32601, f"Unknown method: {method}")
-        except Exception as e:
-            logging.exception(f"Exception handling request {method}")
-            output = build_error_response(request_id, -32603, f"Internal error: {str(e)}")
+        if method == "tools/call":
+            in_flight[request_id] = asyncio.create_task(run_tool_call(request_id, method, params))
+        else:
+            write_message(handle_request(method, params, request_id))
 
-        response_str = json.dumps(output)
-        logging.debug(f"Sending response: {response_str}")
-        print(response_str)
-        sys.stdout.flush()
+    # stdin closed: let in-flight requests finish before exiting
+    if in_flight:
+        await asyncio.gather(*list(in_flight.values()), return_exceptions=True)
+    executor.shutdown(wait=False)
+
+def main():
+    if "--build-catalog" in sys.argv[1:]:
+        # Build (or refresh) metrics_cache.json and exit, so a pool of servers
+        # can all start from the same warm catalog instead of each rebuilding it
+        dbt_client.refreshMetrics()
+        return
+    logging.info("dbt Semantic Layer MCP Python server starting up. Listening on stdin for JSON-RPC requests...")
+    asyncio.run(serve(max_workers=int(os.environ.get("MCP_MAX_WORKERS", 4))))
 
 
 if __name__ == "__main__":
@@ -1,10 +1,14 @@
 import os
 import requests
 import duckdb
+import pandas as pd
 import datetime
 import time
 import json
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -12,142 +16,741 @@ load_dotenv()
 
 # Retrieve the API key from the environment
 API_KEY = os.getenv("COINGECKO_API_KEY")
-
-# Parse command-line arguments.
-parser = argparse.ArgumentParser(
-    description="Fetch historical coin data from CoinGecko and store in DuckDB"
-)
-parser.add_argument(
-    "--coins",
-    type=str,
-    default="bitcoin",
-    help="Comma separated list of coin IDs (e.g. bitcoin,ethereum)"
-)
-args = parser.parse_args()
-
-# Create a list of coin IDs stripping any extra whitespace.
-coins = [coin.strip() for coin in args.coins.split(',') if coin.strip()]
-
-# Define the period: one year from (today - 365 days) to today.
-start_date = datetime.date.today() - datetime.timedelta(days=365)
-end_date = datetime.date.today()
+API_BASE_URL = "https://api.coingecko.com/api/v3"
 
 # Maximum number of retries for 429 responses.
-max_retries = 5
-retry_delay = 5  # seconds to wait between retries
+MAX_RETRIES = 5
+# Base backoff (seconds) used when a 429 response carries no Retry-After header.
+RETRY_DELAY = 5
 
 # Construct the database path relative to the root of the project
-db_path = os.path.join("coindbt", "warehouse.duckdb")
+DB_PATH = os.path.join("coindbt", "warehouse.duckdb")
 
-# Connect to (or create) the DuckDB database.
-conn = duckdb.connect(db_path)
 
-# Iterate over each coin.
-for original_coin in coins:
-    # Use the original name with hyphens for API and prepare a safe SQL identifier
-    api_coin = original_coin
-    sql_coin = original_coin.replace("-", "_")
+def parse_args():
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Fetch historical coin data from CoinGecko and store in DuckDB"
+    )
+    parser.add_argument(
+        "--coins",
+        type=str,
+        default="bitcoin",
+        help="Comma separated list of coin IDs (e.g. bitcoin,ethereum)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of concurrent fetch workers (1 keeps the serial behaviour)"
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=30,
+        help="Global API budget in requests per minute shared by all workers "
+             "(the CoinGecko demo plan allows 30)"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["history", "range"],
+        default="history",
+        help="history: one /history call per coin and day. "
+             "range: bulk backfill from /market_chart/range in a few chunked calls per coin"
+    )
+    parser.add_argument(
+        "--vs-currency",
+        type=str,
+        default="usd",
+        help="Quote currency requested from /market_chart/range (range mode)"
+    )
+    parser.add_argument(
+        "--range-chunk-days",
+        type=int,
+        default=366,
+        help="Days per /market_chart/range request (range mode); the default covers the "
+             "whole one-year window in one call. CoinGecko returns daily points for spans "
+             "above 90 days and hourly points below"
+    )
+    parser.add_argument(
+        "--history-fallback",
+        action="store_true",
+        help="In range mode, also call /history for days still lacking "
+             "developer_data/public_interest_stats, which the range endpoint does not return"
+    )
+    parser.add_argument(
+        "--refresh-days",
+        type=int,
+        default=2,
+        help="Always re-fetch the most recent N days (default: yesterday and today), "
+             "whose snapshots may still change"
+    )
+    parser.add_argument(
+        "--storage",
+        choices=["per-coin", "long"],
+        default="per-coin",
+        help="per-coin: one <coin>_history table per coin. "
+             "long: every coin in one coin_history table keyed by (coin, date)"
+    )
+    parser.add_argument(
+        "--cluster",
+        action="store_true",
+        help="With --storage long, rewrite coin_history sorted by (coin, date) after "
+             "loading so single-coin scans only touch that coin's row groups"
+    )
+    parser.add_argument(
+        "--export-parquet",
+        type=str,
+        default=None,
+        help="With --storage long, export coin_history as Hive-partitioned Parquet "
+             "(coin=<name>/...) under this directory"
+    )
+    parser.add_argument(
+        "--typed-columns",
+        action="store_true",
+        help="Extract prices, market caps, volumes and developer/public interest stats "
+             "into typed DOUBLE/INTEGER columns at load time; raw payloads are kept as JSON"
+    )
+    parser.add_argument(
+        "--typed-currencies",
+        type=str,
+        default="usd",
+        help="Comma separated vs-currencies that get typed price/market cap/volume columns"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=500,
+        help="Fetched records buffered before they are upserted and committed"
+    )
+    parser.add_argument(
+        "--flush-seconds",
+        type=float,
+        default=30,
+        help="Also flush buffered records at least this often"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only print the planned work (missing days, request count, duration) and exit"
+    )
+    args = parser.parse_args()
+    if args.storage != "long" and (args.cluster or args.export_parquet):
+        parser.error("--cluster and --export-parquet require --storage long")
+    return args
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by every fetch worker.
+
+    Tokens refill continuously at ``requests_per_minute / 60`` per second up to
+    ``capacity``. A 429 response can pause the whole bucket so that every
+    worker honours the server's Retry-After, not just the one that got it.
+    """
+
+    def __init__(self, requests_per_minute, capacity=1):
+        if requests_per_minute <= 0:
+            raise ValueError("requests_per_minute must be positive")
+        self.rate = requests_per_minute / 60.0
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then consume it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for ``seconds`` and drain the bucket."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+
+def retry_after_seconds(response, attempt):
+    """
+    Seconds to wait after a 429, taken from the Retry-After header (either
+    delta-seconds or an HTTP date) or, failing that, exponential backoff.
+    """
+    header = response.headers.get("Retry-After")
+    if header:
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(header)
+                now = datetime.datetime.now(datetime.timezone.utc)
+                return max(0.0, (retry_at - now).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return RETRY_DELAY * 2 ** (attempt - 1)
 
-    # Create (or update) the table to store historical data.
+
+def build_session(workers):
+    """Create an HTTP session whose connection pool fits every worker."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, workers))
+    session.mount("https://", adapter)
+    session.headers.update({
+        "accept": "application/json",
+        "x-cg-demo-api-key": API_KEY
+    })
+    return session
+
+
+def api_get(session, limiter, url, params, label):
+    """
+    GET a CoinGecko endpoint under the shared rate limiter, retrying 429s.
+    ``label`` identifies the request in log lines. Returns the JSON or None.
+    """
+    retry_count = 0
+    while True:
+        limiter.acquire()
+        try:
+            response = session.get(url, params=params, timeout=30)
+        except Exception as e:
+            print(f"Exception on {label}: {str(e)}")
+            return None
+
+        if response.status_code == 200:
+            return response.json()
+        elif response.status_code == 429:
+            retry_count += 1
+            if retry_count > MAX_RETRIES:
+                print(f"Too many retries for {label} (HTTP 429). Skipping.")
+                return None
+            delay = retry_after_seconds(response, retry_count)
+            print(f"HTTP 429 received for {label}. Retrying in {delay:.1f} seconds (retry {retry_count}/{MAX_RETRIES})...")
+            limiter.pause(delay)
+        else:
+            print(f"Error fetching {label}: HTTP {response.status_code}. Skipping.")
+            return None
+
+
+def fetch_coin_day(session, limiter, api_coin, current_date):
+    """Fetch the /history snapshot of one coin on one day. Returns the JSON or None."""
+    date_str = current_date.strftime("%d-%m-%Y")  # API requires dd-mm-yyyy format.
+    print(f"Fetching data for {api_coin} on {current_date}...")
+    return api_get(
+        session, limiter,
+        f"{API_BASE_URL}/coins/{api_coin}/history",
+        {"date": date_str},
+        f"{api_coin} on {current_date}"
+    )
+
+
+def date_chunks(start_date, end_date, chunk_days):
+    """Split [start_date, end_date] into consecutive inclusive spans of at most chunk_days."""
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        chunk_end = min(end_date, chunk_start + datetime.timedelta(days=chunk_days - 1))
+        yield chunk_start, chunk_end
+        chunk_start = chunk_end + datetime.timedelta(days=1)
+
+
+def fetch_coin_range(session, limiter, api_coin, vs_currency, chunk_start, chunk_end):
+    """Fetch prices, market caps and volumes for a whole date span from /market_chart/range."""
+    range_from = datetime.datetime.combine(chunk_start, datetime.time.min, datetime.timezone.utc)
+    range_to = datetime.datetime.combine(chunk_end, datetime.time.max, datetime.timezone.utc)
+    print(f"Fetching market chart for {api_coin} from {chunk_start} to {chunk_end}...")
+    return api_get(
+        session, limiter,
+        f"{API_BASE_URL}/coins/{api_coin}/market_chart/range",
+        {
+            "vs_currency": vs_currency,
+            "from": int(range_from.timestamp()),
+            "to": int(range_to.timestamp()),
+        },
+        f"{api_coin} market chart {chunk_start}..{chunk_end}"
+    )
+
+
+LONG_HISTORY_TABLE = "coin_history"
+
+
+def history_table_name(sql_coin, storage):
+    """Table holding a coin's history: its own table, or the shared long-format one."""
+    return LONG_HISTORY_TABLE if storage == "long" else f"{sql_coin}_history"
+
+
+DEVELOPER_FIELDS = [
+    "forks",
+    "stars",
+    "subscribers",
+    "total_issues",
+    "closed_issues",
+    "pull_requests_merged",
+    "pull_request_contributors",
+    "commit_count_4_weeks",
+]
+PUBLIC_INTEREST_FIELDS = ["alexa_rank", "bing_matches"]
+
+
+def typed_columns(vs_currencies):
+    """
+    Columns extracted from the payloads at load time, as
+    {column: (sql_type, payload_column, json_path)}. Names match the
+    extraction_fields used by the denorm models (e.g. current_price_usd).
+    """
+    columns = {}
+    for vs_currency in vs_currencies:
+        for field in ("current_price", "market_cap", "total_volume"):
+            columns[f"{field}_{vs_currency}"] = ("DOUBLE", "market_data", f"$.{field}.{vs_currency}")
+    for field in DEVELOPER_FIELDS:
+        columns[field] = ("INTEGER", "developer_data", f"$.{field}")
+    for field in PUBLIC_INTEREST_FIELDS:
+        columns[field] = ("INTEGER", "public_interest_stats", f"$.{field}")
+    return columns
+
+
+def typed_column_expression(sql_type, payload_column, json_path):
+    return f"try_cast(json_extract({payload_column}, '{json_path}') AS {sql_type})"
+
+
+def create_history_table(conn, sql_coin, storage="per-coin", typed=None):
+    """
+    Create (or update) the table to store historical data.
+
+    With ``typed`` (see typed_columns) new tables keep the raw payloads as
+    DuckDB JSON and the typed columns are added if missing, back-filled once
+    from the payloads already stored.
+    """
+    table = history_table_name(sql_coin, storage)
+    raw_type = "JSON" if typed else "TEXT"
+    coin_column = "coin TEXT," if storage == "long" else ""
     conn.execute(f"""
-    CREATE TABLE IF NOT EXISTS {sql_coin}_history (
+    CREATE TABLE IF NOT EXISTS {table} (
+        {coin_column}
         date DATE,
         id TEXT,
         symbol TEXT,
         name TEXT,
-        market_data TEXT,
-        developer_data TEXT,
-        public_interest_stats TEXT
+        market_data {raw_type},
+        developer_data {raw_type},
+        public_interest_stats {raw_type}
+    )
+    """)
+    if not typed:
+        return
+
+    existing = {
+        row[0] for row in conn.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_schema = 'main' AND table_name = ?",
+            (table,)
+        ).fetchall()
+    }
+    added = [column for column in typed if column not in existing]
+    for column in added:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {typed[column][0]}")
+    if added:
+        assignments = ", ".join(f"{column} = {typed_column_expression(*typed[column])}" for column in added)
+        conn.execute(f"UPDATE {table} SET {assignments}")
+        print(f"Added typed columns to {table}: {', '.join(added)}")
+
+
+def create_market_chart_table(conn, sql_coin):
+    """
+    Create the raw market_chart table read by the transform_coin macro
+    (declared as source warehouse_<coin>.market_chart in models/src/coingecko.yml).
+    """
+    conn.execute(f"CREATE SCHEMA IF NOT EXISTS {sql_coin}")
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {sql_coin}.market_chart (
+        id TEXT,
+        vs_currency TEXT,
+        range_start DATE,
+        range_end DATE,
+        prices TEXT,
+        market_caps TEXT,
+        total_volumes TEXT,
+        fetched_at TIMESTAMP
     )
     """)
-    print(f"Processing coin: {api_coin}")
-    
-    current_date = start_date
-    while current_date <= end_date:
-        # Check if data for this coin on this date already exists.
-        existing = conn.execute(
-            f"SELECT * FROM {sql_coin}_history WHERE date = ? AND id = ?",
-            (current_date, original_coin)
-        ).fetchone()
-        
-        # Determine if current_date is within one week from today.
-        within_last_week = current_date >= (end_date - datetime.timedelta(days=1))
-        
-        if existing is not None:
-            if within_last_week:
-                print(f"Record for {api_coin} on {current_date} exists and is within last week, updating it...")
-            else:
-                print(f"Record for {api_coin} on {current_date} already exists, skipping API call.")
-            current_date += datetime.timedelta(days=1)
+
+
+def insert_market_chart(conn, sql_coin, api_coin, vs_currency, chunk_start, chunk_end, data):
+    """Replace the raw market_chart payload stored for one coin and span."""
+    conn.execute(
+        f"DELETE FROM {sql_coin}.market_chart WHERE id = ? AND vs_currency = ? AND range_start = ? AND range_end = ?",
+        (api_coin, vs_currency, chunk_start, chunk_end)
+    )
+    conn.execute(
+        f"INSERT INTO {sql_coin}.market_chart VALUES (?, ?, ?, ?, ?, ?, ?, current_timestamp)",
+        (
+            api_coin,
+            vs_currency,
+            chunk_start,
+            chunk_end,
+            json.dumps(data.get("prices", [])),
+            json.dumps(data.get("market_caps", [])),
+            json.dumps(data.get("total_volumes", [])),
+        )
+    )
+
+
+def market_chart_daily_records(api_coin, vs_currency, data):
+    """
+    Collapse a /market_chart/range payload into one /history-shaped record per
+    UTC day (first point of the day), so the denorm models can read range
+    backfills exactly like /history snapshots. developer_data and
+    public_interest_stats are left empty: the range endpoint has no such fields.
+    """
+    days = {}
+    for field, key in (("prices", "current_price"), ("market_caps", "market_cap"), ("total_volumes", "total_volume")):
+        for timestamp_ms, value in data.get(field) or []:
+            day = datetime.datetime.fromtimestamp(timestamp_ms / 1000, datetime.timezone.utc).date()
+            market_data = days.setdefault(day, {})
+            market_data.setdefault(key, {}).setdefault(vs_currency, value)
+    return {
+        day: {"id": api_coin, "market_data": market_data}
+        for day, market_data in days.items()
+    }
+
+
+HISTORY_COLUMNS = ["date", "id", "symbol", "name", "market_data", "developer_data", "public_interest_stats"]
+
+
+def history_row(current_date, data):
+    """Turn one /history-shaped payload into a row of the coin's history table."""
+    # Extract additional fields and convert to JSON string if available.
+    market_data = data.get("market_data")
+    developer_data = data.get("developer_data")
+    public_interest_stats = data.get("public_interest_stats")
+    return (
+        current_date,
+        data.get("id"),
+        data.get("symbol"),
+        data.get("name"),
+        json.dumps(market_data) if market_data else None,
+        json.dumps(developer_data) if developer_data else None,
+        json.dumps(public_interest_stats) if public_interest_stats else None,
+    )
+
+
+class IngestBuffer:
+    """
+    Accumulates fetched history rows and upserts them in batches into the
+    per-coin tables or, with ``storage="long"``, the shared coin_history table.
+
+    A flush happens once ``batch_size`` rows are pending or ``flush_seconds``
+    have passed since the last one. Each table's batch is written as one
+    DataFrame: a DELETE ... USING on (id, date) followed by INSERT ... SELECT,
+    committed in its own transaction so progress survives a crash and a rerun
+    only fetches what is still missing. Typed columns, if any, are extracted
+    from the batch's payloads inside that same INSERT.
+
+    Rows added with ``market_data_only`` (range backfills) only fill days
+    that have no row yet; on existing days their market_data is merged into
+    the stored payload and every other field is kept.
+    """
+
+    def __init__(self, conn, batch_size=500, flush_seconds=30, storage="per-coin", typed=None):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.storage = storage
+        self.typed = typed or {}
+        self._rows = {}  # table -> {(id, date): row}; later rows win
+        self._market_rows = {}  # table -> {(id, date): row} added with market_data_only
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def add(self, sql_coin, current_date, data, market_data_only=False):
+        row = history_row(current_date, data)
+        key = (row[1], current_date)
+        if self.storage == "long":
+            row = (sql_coin,) + row
+        table = history_table_name(sql_coin, self.storage)
+        full_rows = self._rows.setdefault(table, {})
+        market_rows = self._market_rows.setdefault(table, {})
+        if market_data_only:
+            if key in full_rows:
+                return  # a complete /history row for the day is already pending
+            table_rows = market_rows
+        else:
+            if market_rows.pop(key, None) is not None:
+                self._pending -= 1
+            table_rows = full_rows
+        if key not in table_rows:
+            self._pending += 1
+        table_rows[key] = row
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if self._pending >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        for market_data_only, pending in ((False, self._rows), (True, self._market_rows)):
+            for table, table_rows in pending.items():
+                if table_rows:
+                    self._write(table, list(table_rows.values()), market_data_only)
+        self._rows = {}
+        self._market_rows = {}
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def _write(self, table, rows, market_data_only):
+        long_format = self.storage == "long"
+        columns = (["coin"] if long_format else []) + HISTORY_COLUMNS
+        target_columns = columns + list(self.typed)
+        select_list = ", ".join(
+            ["CAST(date AS DATE)" if column == "date" else column for column in columns]
+            + [typed_column_expression(*spec) for spec in self.typed.values()]
+        )
+        batch = pd.DataFrame(rows, columns=columns)
+        self.conn.register("ingest_batch", batch)
+        try:
+            self.conn.begin()
+            if market_data_only:
+                # Merge into the rows already stored for these days
+                batch = self.conn.execute(f"""
+                    SELECT {"ingest_batch.coin, " if long_format else ""}
+                           CAST(ingest_batch.date AS DATE) AS date,
+                           ingest_batch.id,
+                           coalesce({table}.symbol, ingest_batch.symbol) AS symbol,
+                           coalesce({table}.name, ingest_batch.name) AS name,
+                           CASE WHEN {table}.market_data IS NULL THEN ingest_batch.market_data
+                                ELSE CAST(json_merge_patch({table}.market_data, ingest_batch.market_data) AS VARCHAR)
+                           END AS market_data,
+                           {table}.developer_data,
+                           {table}.public_interest_stats
+                    FROM ingest_batch
+                    LEFT JOIN {table}
+                      ON {table}.id = ingest_batch.id
+                     AND {table}.date = CAST(ingest_batch.date AS DATE)
+                """).df()
+                self.conn.unregister("ingest_batch")
+                self.conn.register("ingest_batch", batch)
+            self.conn.execute(f"""
+                DELETE FROM {table}
+                USING ingest_batch
+                WHERE {table}.id = ingest_batch.id
+                  AND {table}.date = ingest_batch.date
+            """)
+            # Appending each batch in (coin, date) order keeps zone maps tight.
+            self.conn.execute(f"""
+                INSERT INTO {table} ({", ".join(target_columns)})
+                SELECT {select_list}
+                FROM ingest_batch
+                ORDER BY {"coin, " if long_format else ""}date
+            """)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self.conn.unregister("ingest_batch")
+        print(f"Flushed {len(rows)} records into {table}")
+
+
+def missing_dates(conn, table, api_coin, start_date, end_date, refresh_from, require_developer_data=False):
+    """
+    Dates in [start_date, end_date] that need fetching for one coin, computed
+    with a single anti-join of a generated date series against the history
+    table. Days on or after ``refresh_from`` are always included. With
+    ``require_developer_data`` rows without developer_data count as missing.
+    """
+    present_filter = "AND developer_data IS NOT NULL" if require_developer_data else ""
+    rows = conn.execute(f"""
+        WITH series AS (
+            SELECT CAST(generate_series AS DATE) AS date
+            FROM generate_series(CAST(? AS DATE), CAST(? AS DATE), INTERVAL 1 DAY)
+        ),
+        present AS (
+            SELECT DISTINCT date
+            FROM {table}
+            WHERE id = ? AND date BETWEEN ? AND ? {present_filter}
+        )
+        SELECT series.date FROM series ANTI JOIN present ON series.date = present.date
+        UNION
+        SELECT date FROM series WHERE date >= ?
+        ORDER BY date
+    """, (start_date, end_date, api_coin, start_date, end_date, refresh_from)).fetchall()
+    return [row[0] for row in rows]
+
+
+def plan_missing_dates(conn, coins, start_date, end_date, refresh_from, require_developer_data=False,
+                       storage="per-coin"):
+    """Return {(api_coin, sql_coin): [dates to fetch]} for every coin."""
+    plan = {}
+    for original_coin in coins:
+        # Use the original name with hyphens for API and prepare a safe SQL identifier
+        api_coin = original_coin
+        sql_coin = original_coin.replace("-", "_")
+        plan[(api_coin, sql_coin)] = missing_dates(
+            conn, history_table_name(sql_coin, storage), api_coin, start_date, end_date, refresh_from, require_developer_data
+        )
+    return plan
+
+
+def plan_range_chunks(plan, chunk_days):
+    """Range requests covering each coin's missing days: [(api_coin, sql_coin, chunk_start, chunk_end)]."""
+    chunks = []
+    for (api_coin, sql_coin), dates in plan.items():
+        if not dates:
+            continue
+        for chunk_start, chunk_end in date_chunks(min(dates), max(dates), chunk_days):
+            chunks.append((api_coin, sql_coin, chunk_start, chunk_end))
+    return chunks
+
+
+def report_plan(plan, request_count, rate_limit, start_date, end_date, mode):
+    """Print the planned work before any API call is made."""
+    missing_total = sum(len(dates) for dates in plan.values())
+    print(f"Planned work for {start_date}..{end_date} (mode={mode}):")
+    for (api_coin, _), dates in plan.items():
+        print(f"  {api_coin:<24} {len(dates):>5} days to fetch")
+    duration = datetime.timedelta(seconds=round(request_count / rate_limit * 60))
+    print(
+        f"  total: {len(plan)} coins, {missing_total} days, {request_count} requests, "
+        f"~{duration} at {rate_limit:g} requests/minute"
+    )
+
+
+def cluster_long_table(conn):
+    """Rewrite coin_history sorted by (coin, date) so each coin occupies contiguous row groups."""
+    conn.execute(f"CREATE OR REPLACE TABLE {LONG_HISTORY_TABLE} AS SELECT * FROM {LONG_HISTORY_TABLE} ORDER BY coin, date")
+    print(f"Clustered {LONG_HISTORY_TABLE} by (coin, date)")
+
+
+def export_parquet(conn, path):
+    """Export coin_history as Hive-partitioned Parquet, one coin=<name> directory per coin."""
+    conn.execute(f"""
+        COPY (SELECT * FROM {LONG_HISTORY_TABLE} ORDER BY coin, date)
+        TO '{path}' (FORMAT PARQUET, PARTITION_BY (coin), OVERWRITE_OR_IGNORE true)
+    """)
+    print(f"Exported {LONG_HISTORY_TABLE} to {path}")
+
+
+def backfill_ranges(conn, buffer, executor, session, limiter, plan, chunks, vs_currency):
+    """
+    Range mode: pull the planned spans in a few /market_chart/range calls,
+    land the raw payload in <coin>.market_chart and write the planned days of
+    <coin>_history from the daily price/market cap/volume. Days that already
+    have a row (e.g. the --refresh-days window) only get their market_data
+    updated; their other /history fields are kept.
+    """
+    futures = {}
+    for api_coin, sql_coin, chunk_start, chunk_end in chunks:
+        create_market_chart_table(conn, sql_coin)
+        future = executor.submit(
+            fetch_coin_range, session, limiter, api_coin, vs_currency, chunk_start, chunk_end
+        )
+        futures[future] = (api_coin, sql_coin, chunk_start, chunk_end)
+
+    for future in as_completed(futures):
+        api_coin, sql_coin, chunk_start, chunk_end = futures[future]
+        data = future.result()
+        if data is None:
             continue
+        insert_market_chart(conn, sql_coin, api_coin, vs_currency, chunk_start, chunk_end, data)
 
-        date_str = current_date.strftime("%d-%m-%Y")  # API requires dd-mm-yyyy format.
-        headers = {
-            "accept": "application/json",
-            "x-cg-demo-api-key": API_KEY
+        wanted = set(plan[(api_coin, sql_coin)])
+        inserted = 0
+        for current_date, record in sorted(market_chart_daily_records(api_coin, vs_currency, data).items()):
+            if current_date not in wanted:
+                continue
+            buffer.add(sql_coin, current_date, record, market_data_only=True)
+            inserted += 1
+        print(f"Stored market chart for {api_coin} {chunk_start}..{chunk_end}, queued {inserted} daily records")
+
+
+def main():
+    args = parse_args()
+
+    # Create a list of coin IDs stripping any extra whitespace.
+    coins = [coin.strip() for coin in args.coins.split(',') if coin.strip()]
+
+    # Define the period: one year from (today - 365 days) to today.
+    start_date = datetime.date.today() - datetime.timedelta(days=365)
+    end_date = datetime.date.today()
+
+    # Connect to (or create) the DuckDB database.
+    conn = duckdb.connect(DB_PATH)
+    typed = None
+    if args.typed_columns:
+        typed = typed_columns([vs.strip() for vs in args.typed_currencies.split(',') if vs.strip()])
+    for original_coin in coins:
+        create_history_table(conn, original_coin.replace("-", "_"), args.storage, typed)
+
+    # 1) Work out what is missing up front, one set-based query per coin.
+    refresh_from = end_date - datetime.timedelta(days=args.refresh_days - 1)
+    plan = plan_missing_dates(conn, coins, start_date, end_date, refresh_from, storage=args.storage)
+    if args.mode == "range":
+        chunks = plan_range_chunks(plan, args.range_chunk_days)
+        request_count = len(chunks)
+        if args.history_fallback:
+            # Every planned day lands without developer_data, so this is exact.
+            fallback_plan = plan_missing_dates(
+                conn, coins, start_date, end_date, refresh_from, require_developer_data=True,
+                storage=args.storage
+            )
+            request_count += sum(len(dates) for dates in fallback_plan.values())
+    else:
+        request_count = sum(len(dates) for dates in plan.values())
+    report_plan(plan, request_count, args.rate_limit, start_date, end_date, args.mode)
+    if args.dry_run:
+        conn.close()
+        return
+
+    # All workers draw from one token bucket; the DuckDB connection is only
+    # touched from this thread.
+    limiter = TokenBucket(args.rate_limit)
+    session = build_session(args.workers)
+    buffer = IngestBuffer(conn, args.batch_size, args.flush_seconds, args.storage, typed)
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        # 2) Range mode lands whole spans first; /history is only a fallback.
+        if args.mode == "range":
+            backfill_ranges(conn, buffer, executor, session, limiter, plan, chunks, args.vs_currency)
+            history_plan = fallback_plan if args.history_fallback else {}
+        else:
+            history_plan = plan
+        jobs = [
+            (api_coin, sql_coin, current_date)
+            for (api_coin, sql_coin), dates in history_plan.items()
+            for current_date in dates
+        ]
+
+        # 3) Fan the per-day /history fetches out over the worker pool.
+        futures = {
+            executor.submit(fetch_coin_day, session, limiter, api_coin, current_date): (api_coin, sql_coin, current_date)
+            for api_coin, sql_coin, current_date in jobs
         }
-        
-        url = f"https://api.coingecko.com/api/v3/coins/{api_coin}/history?date={date_str}"
-        print(f"Fetching data for {api_coin} on {current_date}...")
+        for future in as_completed(futures):
+            api_coin, sql_coin, current_date = futures[future]
+            data = future.result()
+            if data is None:
+                buffer.maybe_flush()
+                continue
+            buffer.add(sql_coin, current_date, data)
+            print(f"Fetched record for {api_coin} on {current_date}")
 
-        retry_count = 0
-        while True:
-            try:
-                response = requests.get(url, headers=headers)
-            except Exception as e:
-                print(f"Exception on {api_coin} for {current_date}: {str(e)}")
-                break
-
-            if response.status_code == 200:
-                data = response.json()
-                # Extract basic coin data.
-                coin_id = data.get("id")
-                symbol = data.get("symbol")
-                name = data.get("name")
-                # Extract additional fields and convert to JSON string if available.
-                market_data = data.get("market_data")
-                developer_data = data.get("developer_data")
-                public_interest_stats = data.get("public_interest_stats")
-                market_data_str = json.dumps(market_data) if market_data else None
-                developer_data_str = json.dumps(developer_data) if developer_data else None
-                public_interest_stats_str = json.dumps(public_interest_stats) if public_interest_stats else None
-
-                if existing is not None and within_last_week:
-                    # Update the existing record.
-                    conn.execute(
-                        f"""
-                        UPDATE {sql_coin}_history 
-                        SET id = ?, symbol = ?, name = ?, market_data = ?, developer_data = ?, public_interest_stats = ?
-                        WHERE date = ?
-                        """,
-                        (coin_id, symbol, name, market_data_str, developer_data_str, public_interest_stats_str, current_date)
-                    )
-                    print(f"Updated record for {api_coin} on {current_date}")
-                else:
-                    # Insert a new record.
-                    conn.execute(
-                        f"INSERT INTO {sql_coin}_history VALUES (?, ?, ?, ?, ?, ?, ?)",
-                        (current_date, coin_id, symbol, name, market_data_str, developer_data_str, public_interest_stats_str)
-                    )
-                    print(f"Inserted new record for {api_coin} on {current_date}")
-                break  # exit retry loop on success
-            elif response.status_code == 429:
-                retry_count += 1
-                if retry_count > max_retries:
-                    print(f"Too many retries for {api_coin} on {current_date} (HTTP 429). Skipping this date.")
-                    break
-                print(f"HTTP 429 received for {api_coin} on {current_date}. Retrying in {retry_delay} seconds (retry {retry_count}/{max_retries})...")
-                time.sleep(retry_delay)
-            else:
-                print(f"Error fetching data for {api_coin} on {current_date}: HTTP {response.status_code}. Skipping this date.")
-                break
-
-        # Pause for a second to respect API rate limits.
-        time.sleep(1)
-        current_date += datetime.timedelta(days=1)
-
-# Commit changes and close the connection.
-conn.commit()
-conn.close()
-
-print("Data retrieval complete and stored in DuckDB database.")
\ No newline at end of file
+    # Write whatever is still buffered and close the connection.
+    buffer.flush()
+    if args.cluster:
+        cluster_long_table(conn)
+    if args.export_parquet:
+        export_parquet(conn, args.export_parquet)
+    conn.close()
+
+    print("Data retrieval complete and stored in DuckDB database.")
+
+
+if __name__ == "__main__":
+    main()
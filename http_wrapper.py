@@ -1,8 +1,15 @@
 # minimal_http_wrapper.py
 from flask import Flask, request, jsonify
+import asyncio
+import duckdb
+import hashlib
+import itertools
 import subprocess
 import json
 import os
+import shutil
+import threading
+import time
 
 app = Flask(__name__)
 
@@ -11,29 +18,309 @@ base_dir = os.path.dirname(os.path.abspath(__file__))
 mcp_script_path = os.path.join(base_dir, "dbt_semantic_layer_mcp_server.py")
 print(f"mcp_script_path: {mcp_script_path}")
 
-# Start your MCP server code in a subprocess
 python_path = os.path.join(base_dir, venv_dir, "bin", "python")
-mcp_process = subprocess.Popen(
-    ["python", str(mcp_script_path)],
-    stdin=subprocess.PIPE,
-    stdout=subprocess.PIPE,
-    text=True
-)
+warehouse_path = os.path.join(base_dir, "coindbt", "warehouse.duckdb")
+snapshot_dir = os.path.join(base_dir, "coindbt", "target", "warehouse_snapshots")
+
+MCP_REQUEST_TIMEOUT = float(os.environ.get("MCP_REQUEST_TIMEOUT", "300"))
+MCP_RESTART_DELAY = 1.0
+MAX_LINE_BYTES = 256 * 1024 * 1024  # query results arrive as one JSON line
+
+# Worker pool: number of server processes, how tools/call requests are routed
+# ("least_loaded" or "hash", which pins identical queries to one worker so its
+# result cache stays hot), health-check cadence, and requests per worker
+# before it is replaced (0 = never).
+#
+# DuckDB lets only one process open warehouse.duckdb read-write, so with
+# MCP_POOL_SIZE > 1 the workers never touch it: they share a read-only
+# snapshot (coindbt/target/warehouse_snapshots/<ns>/warehouse.duckdb, selected
+# through COINDBT_DUCKDB_PATH / COINDBT_DUCKDB_ACCESS_MODE in profiles.yml).
+# The file keeps the name warehouse.duckdb because dbt-duckdb names the
+# database after it and the compiled SQL refers to "warehouse". The
+# snapshot is refreshed at each health check once the warehouse has changed
+# and no dbt run holds its lock, and the workers are then recycled onto it,
+# so pooled results can lag a dbt run by up to MCP_HEALTH_INTERVAL.
+MCP_POOL_SIZE = int(os.environ.get("MCP_POOL_SIZE", "1"))
+MCP_POOL_ROUTING = os.environ.get("MCP_POOL_ROUTING", "least_loaded")
+MCP_HEALTH_INTERVAL = float(os.environ.get("MCP_HEALTH_INTERVAL", "30"))
+MCP_HEALTH_TIMEOUT = float(os.environ.get("MCP_HEALTH_TIMEOUT", "10"))
+MCP_RECYCLE_AFTER = int(os.environ.get("MCP_RECYCLE_AFTER", "0"))
+
+
+class MCPWorker:
+    """
+    One MCP server child process. A single reader task owns its stdout and
+    resolves the waiting request whose id matches each response, so any number
+    of requests can be in flight at once. Ids are rewritten on the way in so
+    HTTP clients that all count from 1 cannot collide, and the child is
+    restarted if it exits. recycle() swaps in a fresh child and lets the old
+    one finish its in-flight requests.
+    """
+
+    def __init__(self, command, loop, recycle_after=0):
+        self.command = command
+        self.loop = loop
+        self.env = None  # environment of the next child (None = inherit)
+        self.recycle_after = recycle_after
+        self.process = None
+        self.pending = {}  # internal id -> (process, asyncio.Future)
+        self.served = 0
+        self._ids = itertools.count(1)
+
+    @property
+    def load(self):
+        return len(self.pending)
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            *self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            limit=MAX_LINE_BYTES,
+            env=self.env,
+        )
+        self.served = 0
+        self.loop.create_task(self._read(self.process))
+
+    async def _read(self, process):
+        try:
+            while True:
+                line = await process.stdout.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue  # stray output, not a JSON-RPC message
+                _, future = self.pending.pop(message.get("id"), (None, None))
+                if future is not None and not future.done():
+                    future.set_result(message)
+        except Exception as e:
+            # e.g. a line longer than MAX_LINE_BYTES: the stream cannot be
+            # resynchronised, so treat it like a crash and restart the server
+            print(f"Reading from MCP server failed ({e!r}), killing it")
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+
+        returncode = await process.wait()
+        for internal_id, (owner, future) in list(self.pending.items()):
+            if owner is process:
+                del self.pending[internal_id]
+                if not future.done():
+                    future.set_exception(ConnectionError(f"MCP server exited with code {returncode}"))
+        if process is self.process:
+            print(f"MCP server exited with code {returncode}, restarting")
+            await asyncio.sleep(MCP_RESTART_DELAY)
+            await self.start()
+
+    async def recycle(self):
+        old = self.process
+        await self.start()
+        # EOF on stdin: the server finishes its in-flight requests, then exits
+        old.stdin.close()
+
+    async def _write(self, process, message):
+        if process is None or process.stdout.at_eof():
+            raise ConnectionError("MCP server is restarting")
+        process.stdin.write((json.dumps(message) + "\n").encode())
+        await process.stdin.drain()
+
+    async def call(self, message, timeout, count=True):
+        """Forward one JSON-RPC message; returns the response, or None for notifications."""
+        process = self.process
+        if "id" not in message:
+            # A client's requestId means nothing after id rewriting, so cancellation
+            # is left to the timeout below rather than forwarded.
+            if message.get("method") != "notifications/cancelled":
+                await self._write(process, message)
+            return None
+
+        if count:
+            self.served += 1
+            if self.recycle_after and self.served == self.recycle_after:
+                self.loop.create_task(self.recycle())
+
+        internal_id = next(self._ids)
+        future = self.loop.create_future()
+        self.pending[internal_id] = (process, future)
+        try:
+            await self._write(process, {**message, "id": internal_id})
+            response = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            await self._write(process, {
+                "jsonrpc": "2.0",
+                "method": "notifications/cancelled",
+                "params": {"requestId": internal_id, "reason": "timeout"},
+            })
+            raise
+        finally:
+            self.pending.pop(internal_id, None)
+        return {**response, "id": message["id"]}
+
+    async def check_health(self, timeout):
+        """Kill the child (and so restart it) if it does not answer tools/list in time."""
+        process = self.process
+        try:
+            await self.call({"jsonrpc": "2.0", "id": "health", "method": "tools/list"}, timeout, count=False)
+        except ConnectionError:
+            return  # already restarting
+        except asyncio.TimeoutError:
+            if process is self.process and process.returncode is None:
+                print(f"MCP server {process.pid} failed its health check, restarting")
+                process.kill()
+
+
+def warehouse_signature():
+    """Changes whenever the warehouse (or its WAL) is written."""
+    signature = []
+    for path in (warehouse_path, warehouse_path + ".wal"):
+        try:
+            st = os.stat(path)
+            signature.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def snapshot_warehouse():
+    """
+    Copy the warehouse into <snapshot_dir>/<ns>/warehouse.duckdb and return
+    its path, or None if it cannot be read right now (a dbt run holds its lock).
+    """
+    stamp = str(time.time_ns())
+    tmp_dir = os.path.join(snapshot_dir, f".{stamp}.tmp")
+    os.makedirs(tmp_dir)
+    connection = duckdb.connect()
+    try:
+        connection.execute(f"ATTACH '{warehouse_path}' AS source (READ_ONLY)")
+        connection.execute(f"ATTACH '{os.path.join(tmp_dir, 'warehouse.duckdb')}' AS snapshot")
+        connection.execute("COPY FROM DATABASE source TO snapshot")
+        connection.execute("DETACH snapshot")
+    except duckdb.Error as e:
+        print(f"Could not snapshot the warehouse: {e}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return None
+    finally:
+        connection.close()
+    path_dir = os.path.join(snapshot_dir, stamp)
+    os.rename(tmp_dir, path_dir)
+    return os.path.join(path_dir, "warehouse.duckdb")
+
+
+class WorkerPool:
+    """
+    MCP_POOL_SIZE server processes behind the one /mcp endpoint. tools/call
+    requests go to the least-loaded worker or, with hash routing, to the
+    worker their arguments hash to; other requests go to the least loaded and
+    notifications to every worker.
+    """
+
+    def __init__(self, command, loop, size, routing, recycle_after):
+        self.command = command
+        self.loop = loop
+        self.routing = routing
+        self.workers = [MCPWorker(command, loop, recycle_after) for _ in range(size)]
+        self.snapshot = None  # (path, warehouse signature it was taken at), pooled mode only
+
+    def _use_snapshot(self, path, signature):
+        """Point future worker processes at a warehouse snapshot and drop older snapshots."""
+        self.snapshot = (path, signature)
+        env = {**os.environ, "COINDBT_DUCKDB_PATH": path, "COINDBT_DUCKDB_ACCESS_MODE": "read_only"}
+        for worker in self.workers:
+            worker.env = env
+        # Workers still on an older snapshot keep reading the unlinked file
+        # until they are recycled and their requests finish
+        current = os.path.dirname(path)
+        for entry in os.listdir(snapshot_dir):
+            stale = os.path.join(snapshot_dir, entry)
+            if stale != current:
+                shutil.rmtree(stale, ignore_errors=True)
+
+    async def start(self):
+        if len(self.workers) > 1:
+            signature = warehouse_signature()
+            path = await self.loop.run_in_executor(None, snapshot_warehouse)
+            if path is None:
+                raise RuntimeError("MCP_POOL_SIZE > 1 needs a snapshot of the warehouse; retry once no dbt run holds it")
+            self._use_snapshot(path, signature)
+            # Build metrics_cache.json once so every worker starts from the warm catalog
+            builder = await asyncio.create_subprocess_exec(*self.command, "--build-catalog", env=self.workers[0].env)
+            await builder.wait()
+        for worker in self.workers:
+            await worker.start()
+        self.loop.create_task(self._health_loop())
+
+    async def _refresh_snapshot(self):
+        """Take a new snapshot if the warehouse changed and move the workers onto it."""
+        signature = warehouse_signature()
+        if self.snapshot is None or signature == self.snapshot[1]:
+            return
+        path = await self.loop.run_in_executor(None, snapshot_warehouse)
+        if path is None:
+            return  # locked by a dbt run; try again at the next health check
+        self._use_snapshot(path, signature)
+        for worker in self.workers:
+            await worker.recycle()
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(MCP_HEALTH_INTERVAL)
+            await asyncio.gather(*(worker.check_health(MCP_HEALTH_TIMEOUT) for worker in self.workers))
+            try:
+                await self._refresh_snapshot()
+            except Exception as e:
+                print(f"Warehouse snapshot refresh failed: {e}")
+
+    def route(self, message):
+        if self.routing == "hash" and message.get("method") == "tools/call":
+            params = json.dumps(message.get("params", {}), sort_keys=True)
+            digest = hashlib.sha1(params.encode()).digest()
+            return self.workers[int.from_bytes(digest[:4], "big") % len(self.workers)]
+        return min(self.workers, key=lambda worker: worker.load)
+
+    async def call(self, message, timeout):
+        if "id" not in message:
+            # Notifications (e.g. notifications/initialized) go to every worker
+            await asyncio.gather(*(worker.call(message, timeout) for worker in self.workers), return_exceptions=True)
+            return None
+        return await self.route(message).call(message, timeout)
+
+
+# The bridge runs on its own event loop thread; Flask request threads hand it work.
+loop = asyncio.new_event_loop()
+threading.Thread(target=loop.run_forever, name="mcp-bridge", daemon=True).start()
+
+pool = WorkerPool(["python", str(mcp_script_path)], loop, MCP_POOL_SIZE, MCP_POOL_ROUTING, MCP_RECYCLE_AFTER)
+asyncio.run_coroutine_threadsafe(pool.start(), loop).result()
+
+
+def rpc_error(request_id, message, code=-32603):
+    return {"jsonrpc": "2.0", "id": request_id, "error": {"code": code, "message": message}}
+
 
 @app.route("/mcp", methods=["POST"])
 def handle_mcp():
     req_body = request.get_json()
-    # forward it to the MCP server’s stdin
-    mcp_process.stdin.write(json.dumps(req_body) + "\n")
-    mcp_process.stdin.flush()
-    # read one line of output from server stdout
-    resp_line = mcp_process.stdout.readline().strip()
-    # parse and return
+    if not isinstance(req_body, dict):
+        return jsonify(rpc_error(None, "Expected a single JSON-RPC object", -32600)), 400
+    request_id = req_body.get("id")
+
+    future = asyncio.run_coroutine_threadsafe(pool.call(req_body, MCP_REQUEST_TIMEOUT), loop)
     try:
-        resp_json = json.loads(resp_line)
-        return jsonify(resp_json)
+        resp_json = future.result()
+    except (asyncio.TimeoutError, TimeoutError):
+        return jsonify(rpc_error(request_id, f"MCP request timed out after {MCP_REQUEST_TIMEOUT:g}s"))
+    except ConnectionError as e:
+        # 502 so clients retry once the child is back up
+        return jsonify(rpc_error(request_id, str(e))), 502
     except Exception as e:
-        return jsonify({"error": f"Failed to parse MCP response: {e}"}), 500
+        return jsonify(rpc_error(request_id, f"MCP bridge error: {e}")), 500
+
+    if resp_json is None:
+        return "", 202
+    return jsonify(resp_json)
 
 if __name__ == "__main__":
-    app.run(port=8000)
+    app.run(port=8000, threaded=True)
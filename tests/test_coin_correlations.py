@@ -0,0 +1,147 @@
+"""
+Incremental runs of the coin_correlations python model must leave the same
+table as a full rebuild. The model runs against DuckDB with a stand-in for
+dbt-duckdb's ``dbt`` object, and delete+insert is applied as dbt would.
+"""
+import importlib.util
+import os
+
+import duckdb
+import numpy as np
+import pandas as pd
+import pytest
+
+MODEL_PATH = os.path.join(os.path.dirname(__file__), "..", "coindbt", "models", "coin_correlations.py")
+spec = importlib.util.spec_from_file_location("coin_correlations", MODEL_PATH)
+coin_correlations = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(coin_correlations)
+
+KEYS = coin_correlations.KEY_COLUMNS
+
+
+class FakeConfig(dict):
+    def __call__(self, **kwargs):
+        self.update(kwargs)
+
+
+class FakeDbt:
+    this = "coin_correlations"
+
+    def __init__(self, con, is_incremental):
+        self.con = con
+        self.is_incremental = is_incremental
+        self.config = FakeConfig()
+
+    def ref(self, name):
+        return self.con.table(name)
+
+
+def coin_prices(days, coins, seed=0):
+    rng = np.random.default_rng(seed)
+    data = {"date": pd.date_range("2022-11-01", periods=days).date}
+    for coin in coins:
+        prices = np.exp(np.cumsum(rng.normal(0, 0.03, days))) * 10 ** rng.uniform(-2, 4)
+        prices[rng.random(days) < 0.05] = np.nan
+        data[f"{coin}_current_price_usd"] = prices
+        data[f"{coin}_market_cap_usd"] = prices * 1e6
+    return pd.DataFrame(data)
+
+
+def load_source(con, frame):
+    con.execute("DROP TABLE IF EXISTS denorm_all_coins")
+    con.register("source_frame", frame)
+    con.execute("CREATE TABLE denorm_all_coins AS SELECT * FROM source_frame")
+    con.unregister("source_frame")
+
+
+def run_model(con):
+    """Run the model once, creating or delete+inserting into its table; returns the emitted rows."""
+    exists = con.execute(
+        "SELECT count(*) FROM information_schema.tables WHERE table_name = 'coin_correlations'"
+    ).fetchone()[0]
+    output = coin_correlations.model(FakeDbt(con, bool(exists)), con)
+    con.register("model_output", output)
+    if exists:
+        join = " AND ".join(f"t.{key} = o.{key}" for key in KEYS)
+        con.execute(f"DELETE FROM coin_correlations t USING model_output o WHERE {join}")
+        con.execute("INSERT INTO coin_correlations SELECT * FROM model_output")
+    else:
+        con.execute("CREATE TABLE coin_correlations AS SELECT * FROM model_output")
+    con.unregister("model_output")
+    return output
+
+
+def full_rebuild(frame):
+    con = duckdb.connect()
+    load_source(con, frame)
+    run_model(con)
+    return con.execute("SELECT * FROM coin_correlations").df()
+
+
+def assert_same_table(got, expected):
+    merged = expected.merge(got, on=KEYS, how="outer", suffixes=("_expected", "_got"), indicator=True)
+    assert (merged["_merge"] == "both").all(), merged.loc[merged["_merge"] != "both", KEYS + ["_merge"]]
+    for column in ["correlation"] + coin_correlations.STAT_COLUMNS:
+        np.testing.assert_allclose(
+            merged[f"{column}_got"].astype(float), merged[f"{column}_expected"].astype(float),
+            rtol=1e-9, atol=1e-9, err_msg=column,
+        )
+
+
+@pytest.fixture
+def prices():
+    return coin_prices(400, ["btc", "eth", "sol", "ada"])
+
+
+def test_incremental_matches_full_rebuild_after_new_days(prices):
+    con = duckdb.connect()
+    load_source(con, prices.iloc[:300])
+    run_model(con)
+    load_source(con, prices)
+    output = run_model(con)
+
+    # Only the quarters with new days (and their year / overall) are recomputed:
+    # the first load ended on 2023-08-27
+    quarters = set(output.loc[output["time_period_type"] == "quarterly", "time_period"])
+    assert quarters == {"2023Q3", "2023Q4"}
+    assert_same_table(con.execute("SELECT * FROM coin_correlations").df(), full_rebuild(prices))
+
+
+def test_incremental_matches_full_rebuild_after_past_day_changes(prices):
+    con = duckdb.connect()
+    load_source(con, prices)
+    run_model(con)
+    revised = prices.copy()
+    revised.loc[40, "eth_current_price_usd"] *= 1.5
+    load_source(con, revised)
+    run_model(con)
+
+    assert_same_table(con.execute("SELECT * FROM coin_correlations").df(), full_rebuild(revised))
+
+
+def test_removed_coin_rows_are_deleted(prices):
+    con = duckdb.connect()
+    load_source(con, prices)
+    run_model(con)
+    remaining = prices.drop(columns=["sol_current_price_usd", "sol_market_cap_usd"])
+    load_source(con, remaining)
+    run_model(con)
+
+    table = con.execute("SELECT * FROM coin_correlations").df()
+    assert not ((table["coin1"] == "sol_current_price_usd") | (table["coin2"] == "sol_current_price_usd")).any()
+    assert_same_table(table, full_rebuild(remaining))
+
+    # The next run is incremental again rather than another full rebuild
+    output = run_model(con)
+    assert (output["time_period_type"].str.startswith("rolling")).all()
+
+
+def test_rolling_windows_do_not_accumulate(prices):
+    con = duckdb.connect()
+    load_source(con, prices.iloc[:380])
+    run_model(con)
+    for days in (381, 390, 400):
+        load_source(con, prices.iloc[:days])
+        run_model(con)
+
+    assert_same_table(con.execute("SELECT * FROM coin_correlations").df(), full_rebuild(prices))
@@ -0,0 +1,100 @@
+"""
+build_metrics_catalog must list the same group-by names as
+`mf list dimensions --metrics <name>` for simple, ratio and derived metrics,
+including dimensions joined through a foreign entity and metric_time.
+"""
+import importlib.util
+import os
+
+import pytest
+
+SERVER_PATH = os.path.join(os.path.dirname(__file__), "..", "dbt_semantic_layer_mcp_server.py")
+spec = importlib.util.spec_from_file_location("dbt_semantic_layer_mcp_server", SERVER_PATH)
+server = importlib.util.module_from_spec(spec)
+cwd = os.getcwd()
+spec.loader.exec_module(server)
+os.chdir(cwd)  # the module's client pins the process to coindbt/
+
+SEMANTIC_MANIFEST = {
+    "semantic_models": [
+        {
+            "name": "btc_prices",
+            "defaults": {"agg_time_dimension": "date"},
+            "entities": [
+                {"name": "btc_daily", "type": "primary"},
+                {"name": "coin", "type": "foreign"},
+            ],
+            "dimensions": [
+                {"name": "date", "type": "time"},
+                {"name": "symbol", "type": "categorical"},
+            ],
+            "measures": [{"name": "price_sum"}, {"name": "volume_sum"}],
+        },
+        {
+            # No agg_time_dimension: its metrics have no metric_time
+            "name": "coins",
+            "entities": [{"name": "coin", "type": "primary"}],
+            "dimensions": [{"name": "category", "type": "categorical"}],
+            "measures": [{"name": "coin_count"}],
+        },
+    ],
+    "metrics": [
+        {"name": "price", "type": "simple", "type_params": {"measure": {"name": "price_sum"}}},
+        {"name": "volume", "type": "simple", "type_params": {"measure": {"name": "volume_sum"}}},
+        {
+            "name": "price_per_volume",
+            "type": "ratio",
+            "type_params": {"numerator": {"name": "price"}, "denominator": {"name": "volume"}},
+        },
+        {"name": "coins_listed", "type": "simple", "type_params": {"measure": {"name": "coin_count"}}},
+        {
+            "name": "price_per_coin",
+            "type": "derived",
+            "type_params": {"expr": "price / coins_listed", "metrics": [{"name": "price"}, {"name": "coins_listed"}]},
+        },
+    ],
+}
+
+PRICE_DIMENSIONS = ["btc_daily__date", "btc_daily__symbol", "coin__category", "metric_time"]
+
+
+@pytest.fixture
+def catalog():
+    metrics, _ = server.build_metrics_catalog(SEMANTIC_MANIFEST)
+    return {entry["name"]: entry for entry in metrics}
+
+
+def test_simple_metric_has_own_joined_and_metric_time_dimensions(catalog):
+    assert catalog["price"]["dimensions"] == PRICE_DIMENSIONS
+    assert catalog["price"]["timeDimensions"] == ["btc_daily__date", "metric_time"]
+    assert catalog["price"]["semanticModels"] == ["btc_prices"]
+
+
+def test_ratio_metric_resolves_its_input_metrics(catalog):
+    assert catalog["price_per_volume"]["dimensions"] == PRICE_DIMENSIONS
+
+
+def test_metric_without_agg_time_dimension_has_no_metric_time(catalog):
+    assert catalog["coins_listed"]["dimensions"] == ["coin__category"]
+    assert catalog["coins_listed"]["timeDimensions"] == []
+
+
+def test_derived_metric_has_dimensions_common_to_its_inputs(catalog):
+    assert catalog["price_per_coin"]["dimensions"] == ["coin__category"]
+    assert catalog["price_per_coin"]["semanticModels"] == ["btc_prices", "coins"]
+
+
+def test_unchanged_metrics_are_reused_from_previous_snapshot(catalog):
+    metrics, signatures = server.build_metrics_catalog(SEMANTIC_MANIFEST)
+    previous = {"metrics": metrics, "signatures": signatures}
+    again, again_signatures = server.build_metrics_catalog(SEMANTIC_MANIFEST, previous=previous)
+    assert again_signatures == signatures
+    assert all(new is old for new, old in zip(again, metrics))
+
+
+def test_grain_suffixes_only_on_time_dimensions(catalog):
+    index = server.CatalogIndex(list(catalog.values()))
+    assert index.supports("price", "metric_time__month")
+    assert index.supports("price", "btc_daily__date__week")
+    assert not index.supports("price", "btc_daily__symbol__month")
+    assert index.metrics_for_dimension("coin__category") == frozenset(catalog)